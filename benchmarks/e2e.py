@@ -0,0 +1,137 @@
+# End-to-end throughput of e621dl against the local stand-in server.
+#
+# Generates a corpus, starts benchmarks/fake_e621.py in a thread,
+# writes a config with one section per tag into a fresh work folder
+# and runs e621dl.main() there. Stage times come from the trace
+# of the run, counters from e621dl_lib.metrics.
+#
+# Usage, from e621dl folder:
+#     python benchmarks/e2e.py [--posts 2000] [--sections 20] [--engine threads]
+#                              [--latency-ms 0] [--bandwidth-kbps 0] [--error-rate 0]
+#                              [--json results.json]
+
+# Internal Imports
+import argparse
+import json
+import os
+import sys
+import tempfile
+from collections import defaultdict
+from time import perf_counter
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+sys.path.insert(0, BENCHMARKS)
+
+# Personal Imports
+from fake_e621 import Corpus, FakeE621
+
+def write_config(args):
+    os.makedirs('configs', exist_ok=True)
+    lines = ['[Settings]',
+             'headless = true',
+             'api_rate = 10000',
+             'api_burst = 100',
+             f'download_engine = {args.engine}',
+             f'concurrent_downloads = {args.workers}',
+             f'concurrent_searches = {args.searches}',
+             f'prefetch_pages = {args.prefetch}',
+             'trace_file = trace.json',
+             '',
+             '[Defaults]',
+             'days = 3650',
+             'ratings = s q e',
+             '']
+    if args.prefilter:
+        # One search for all sections, as in README
+        lines += ['[Prefilter]', 'tags = ' + ' '.join(f'~tag_{i}' for i in range(args.sections)), '']
+    for i in range(args.sections):
+        lines += [f'[section_{i}]', f'tags = tag_{i}', '']
+    with open('configs/bench.ini', 'w') as outfile:
+        outfile.write('\n'.join(lines))
+
+def stage_times(filename):
+    with open(filename) as infile:
+        events = json.load(infile)['traceEvents']
+    stages = defaultdict(lambda: {'count': 0, 'total_s': 0.0})
+    for event in events:
+        if event['ph'] != 'X':
+            continue
+        stage = stages[event['name']]
+        stage['count'] += 1
+        stage['total_s'] += event['dur'] / 1e6
+    return dict(stages)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='e621dl end-to-end benchmark')
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--tags', type=int, default=200)
+    parser.add_argument('--sections', type=int, default=20)
+    parser.add_argument('--prefilter', action='store_true',
+                        help='fetch everything once through [Prefilter]')
+    parser.add_argument('--file-size', type=int, default=20_000)
+    parser.add_argument('--engine', choices=('threads', 'async'), default='threads')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--searches', type=int, default=1)
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-kbps', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--workdir', help='kept after the run, a temporary folder by default')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args(args)
+
+    corpus_start = perf_counter()
+    corpus = Corpus(posts=args.posts, tags=args.tags, file_size=args.file_size)
+    print(f'Corpus of {args.posts} posts in {perf_counter() - corpus_start:.1f} s')
+
+    server = FakeE621(corpus, args.latency_ms / 1000, args.bandwidth_kbps * 1024, args.error_rate)
+    base_url = server.start()
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix='e621dl-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    # e621dl keeps its state in the current folder, from import on
+    os.chdir(workdir)
+    write_config(args)
+
+    import e621dl
+    from e621dl_lib import local, metrics, remote
+
+    remote.BASE_URL = base_url
+    local.printer.headless()
+
+    start = perf_counter()
+    e621dl.main()
+    wall = perf_counter() - start
+    server.stop()
+
+    counters = metrics.registry.snapshot()
+    files = counters['e621dl_files_downloaded_total'] + counters['e621dl_files_copied_total']
+    megabytes = counters['e621dl_bytes_downloaded_total'] / 1024 / 1024
+    results = {
+        'args': vars(args),
+        'wall_s': wall,
+        'posts_per_s': counters['e621dl_posts_total'] / wall,
+        'files_per_s': files / wall,
+        'mb_per_s': megabytes / wall,
+        'server_requests': server.requests,
+        'server_errors': server.errors,
+        'counters': {name: value for name, value in counters.items() if not isinstance(value, dict)},
+        'stages': stage_times('trace.json'),
+    }
+
+    print(f'Work folder: {workdir}')
+    print(f"wall {wall:.2f} s, {results['posts_per_s']:.0f} posts/s, "
+          f"{results['files_per_s']:.1f} files/s, {results['mb_per_s']:.2f} MB/s")
+    print(f"server: {server.requests} requests, {server.errors} injected errors")
+    print('stage                     count     total s')
+    for name, stage in sorted(results['stages'].items(), key=lambda item: -item[1]['total_s']):
+        print(f"{name:<24} {stage['count']:>6} {stage['total_s']:>11.3f}")
+
+    if json_path:
+        with open(json_path, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
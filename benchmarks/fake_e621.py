@@ -0,0 +1,274 @@
+# Local stand-in for e621 API and file server, for benchmarks.
+#
+# Serves a synthetic corpus of posts:
+#     /posts.json, /posts/{id}.json, /tags.json, /tag_aliases.json, /data/{md5}.{ext}
+# with optional latency, bandwidth limit and error injection.
+#
+# Usage, from e621dl folder, to poke at it by hand:
+#     python benchmarks/fake_e621.py [--posts 2000] [--port 8621]
+
+# Internal Imports
+import argparse
+import hashlib
+import json
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+RATINGS = ('s', 'q', 'e')
+EXTENSIONS = ('jpg', 'png', 'webm')
+CHUNK_SIZE = 65536
+
+# The same bytes for the same post on every run, so md5 can be checked
+def file_content(post_id, size):
+    block = hashlib.sha256(str(post_id).encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+class Corpus:
+    def __init__(self, posts=2000, tags=200, tags_per_post=20, file_size=20_000, aliases=0, seed=0):
+        rng = random.Random(seed)
+        self.tag_names = [f'tag_{i}' for i in range(tags)]
+        # alias_3 -> tag_3 and so on
+        self.aliases = {f'alias_{i}': self.tag_names[i] for i in range(min(aliases, tags))}
+        self.file_size = file_size
+        self.base_url = ''
+
+        now = datetime.now(timezone.utc)
+        self.posts = []
+        self.md5_to_id = {}
+        for i in range(posts):
+            post_id = posts - i
+            md5 = hashlib.md5(file_content(post_id, file_size)).hexdigest()
+            self.md5_to_id[md5] = post_id
+            post_tags = rng.sample(self.tag_names, min(tags_per_post, tags))
+            self.posts.append({
+                'id': post_id,
+                'created_at': (now - timedelta(minutes=i)).isoformat(timespec='milliseconds'),
+                'tags': {'general': post_tags[1:], 'artist': post_tags[:1]},
+                'rating': rng.choice(RATINGS),
+                'file': {'md5': md5,
+                         'ext': rng.choice(EXTENSIONS),
+                         'size': file_size,
+                         'width': 100,
+                         'height': 100,
+                         },
+                'score': {'total': rng.randint(-10, 100), 'up': 0, 'down': 0},
+                'fav_count': rng.randint(0, 100),
+                'sources': [],
+                'description': '',
+                'pools': [],
+                'uploader_id': 1,
+            })
+            self.posts[-1]['tagset'] = frozenset(post_tags)
+        self.by_id = {post['id']: post for post in self.posts}
+
+        self.post_counts = dict.fromkeys(self.tag_names, 0)
+        for post in self.posts:
+            for tag in post['tagset']:
+                self.post_counts[tag] += 1
+
+    def public(self, post):
+        post = {k: v for k, v in post.items() if k != 'tagset'}
+        post['file'] = {**post['file'],
+                        'url': f"{self.base_url}/data/{post['file']['md5']}.{post['file']['ext']}"}
+        return post
+
+    def search(self, query, limit):
+        required = []
+        excluded = []
+        any_of = []
+        below_id = None
+        rating = None
+        for term in query.split():
+            if term.startswith('id:<'):
+                below_id = int(term[4:])
+            elif term.startswith('rating:'):
+                rating = term[7]
+            elif term.startswith('-'):
+                excluded.append(term[1:])
+            elif term.startswith('~'):
+                any_of.append(term[1:])
+            elif ':' in term:
+                # date:, order: and other metatags, the whole corpus is recent
+                continue
+            else:
+                required.append(term)
+
+        def has(tagset, tag):
+            if '*' in tag:
+                return any(fnmatchcase(name, tag) for name in tagset)
+            return tag in tagset
+
+        results = []
+        for post in self.posts:
+            if below_id is not None and post['id'] >= below_id:
+                continue
+            if rating and post['rating'] != rating:
+                continue
+            tagset = post['tagset']
+            if not all(has(tagset, tag) for tag in required):
+                continue
+            if any(has(tagset, tag) for tag in excluded):
+                continue
+            if any_of and not any(has(tagset, tag) for tag in any_of):
+                continue
+            results.append(self.public(post))
+            if len(results) >= limit:
+                break
+        return results
+
+    def tag(self, name):
+        return {'id': self.tag_names.index(name) + 1, 'name': name,
+                'post_count': self.post_counts[name], 'category': 0}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, Nagle + delayed ACK
+    # would add 40 ms to every response on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def params(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        # requests sends GET payloads as a form body
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qs(self.rfile.read(length).decode()))
+        return url.path, {k: v[0] for k, v in params.items()}
+
+    def send_body(self, status, body, content_type='application/json', extra_headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in extra_headers:
+            self.send_header(*header)
+        self.end_headers()
+
+        bandwidth = self.server.bandwidth
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if bandwidth:
+                sleep(len(chunk) / bandwidth)
+
+    def send_json(self, value):
+        self.send_body(200, json.dumps(value).encode())
+
+    def do_GET(self):
+        server = self.server
+        corpus = server.corpus
+        path, params = self.params()
+        server.requests += 1
+
+        if server.latency:
+            sleep(server.latency)
+        if server.error_rate and server.rng.random() < server.error_rate:
+            server.errors += 1
+            return self.send_body(502, b'{"success": false}')
+
+        if path == '/posts.json':
+            limit = int(params.get('limit', 75))
+            self.send_json({'posts': corpus.search(params.get('tags', ''), limit)})
+
+        elif path.startswith('/posts/') and path.endswith('.json'):
+            post = corpus.by_id.get(int(path[len('/posts/'):-len('.json')]))
+            if post is None:
+                return self.send_body(404, b'{"success": false}')
+            self.send_json({'post': corpus.public(post)})
+
+        elif path == '/tags.json':
+            if 'search[name]' in params:
+                names = [name for name in params['search[name]'].split(',') if name in corpus.post_counts]
+            else:
+                mask = params.get('search[name_matches]', '')
+                names = [name for name in corpus.tag_names if fnmatchcase(name, mask)]
+            tags = [corpus.tag(name) for name in names]
+            self.send_json(tags if tags else {'tags': []})
+
+        elif path == '/tag_aliases.json':
+            if int(params.get('page', 1)) > 1:
+                return self.send_json({'tag_aliases': []})
+            if 'search[antecedent_name]' in params:
+                names = params['search[antecedent_name]'].split()
+            else:
+                mask = params.get('search[name_matches]', '')
+                names = [name for name in corpus.aliases if fnmatchcase(name, mask)]
+            aliases = [{'antecedent_name': name, 'consequent_name': corpus.aliases[name], 'status': 'active'}
+                       for name in names if name in corpus.aliases]
+            self.send_json(aliases if aliases else {'tag_aliases': []})
+
+        elif path.startswith('/data/'):
+            md5 = path[len('/data/'):].split('.')[0]
+            post_id = corpus.md5_to_id.get(md5)
+            if post_id is None:
+                return self.send_body(404, b'')
+            body = file_content(post_id, corpus.file_size)
+            status = 200
+            headers = []
+            range_header = self.headers.get('Range', '')
+            if range_header.startswith('bytes='):
+                start = int(range_header[len('bytes='):].split('-')[0] or 0)
+                if start:
+                    status = 206
+                    headers.append(('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}'))
+                    body = body[start:]
+            server.file_bytes += len(body)
+            self.send_body(status, body, 'application/octet-stream', headers)
+
+        else:
+            self.send_body(404, b'{"success": false}')
+
+class FakeE621(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # latency in seconds per request, bandwidth in bytes per second
+    # per response (0 is unlimited), error_rate is a share of 502 responses
+    def __init__(self, corpus, latency=0.0, bandwidth=0, error_rate=0.0, port=0, seed=0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.corpus = corpus
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.file_bytes = 0
+        self.base_url = corpus.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Local e621 stand-in')
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--tags', type=int, default=200)
+    parser.add_argument('--file-size', type=int, default=20_000)
+    parser.add_argument('--port', type=int, default=8621)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-kbps', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args(args)
+
+    corpus = Corpus(posts=args.posts, tags=args.tags, file_size=args.file_size)
+    server = FakeE621(corpus, args.latency_ms / 1000, args.bandwidth_kbps * 1024, args.error_rate, args.port)
+    print(f'Serving {args.posts} posts at {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+# Micro-benchmarks of per-post filtering and path planning.
+#
+# Builds posts with fake_e621.Corpus and a config-like list of searches
+# (whitelists, anylists, wildcards, conditions, deep subfolder chains),
+# then times the loops every chunk of posts goes through:
+# Post.__init__/generate, process_result(s), conditions,
+# compile_subfolders, get_directories, substitute_illegals_filename
+# and make_path.
+#
+# Every run is saved to benchmarks/results/micro-<version>-<git rev>.json
+# and compared with the previous saved run, or with --compare FILE.
+# Benchmarks slower by more than --threshold are reported as regressions.
+#
+# Usage, from e621dl folder:
+#     python benchmarks/micro.py [--posts 10000] [--sections 500] [--depth 25]
+#                                [--plan-posts 2560] [--sample-sections 50]
+#                                [--rounds 5] [--only get_directories]
+#                                [--compare results.json] [--threshold 10]
+
+# Internal Imports
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+RESULTS_DIR = os.path.join(BENCHMARKS, 'results')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS)
+
+# Personal Imports
+from fake_e621 import Corpus
+
+CHUNK_POSTS = 320
+CONDITIONS = ('{0} & ({1} | {2})', '{0} | {1} | -{2}', '({0} & -{1}) | ({2} & {3})')
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# Searches as process_config makes them, cycling through the kinds
+# of sections real configs have. Sections form subfolder chains
+# depth long, with a few links back up and across to make cycles.
+def make_searches(e621dl, filters, local, tags, count, depth):
+    searches_dict = {}
+    for i in range(count):
+        # Mostly plain whitelists, as in real configs
+        kind = i % 10
+        whitelist, blacklist, anylist = [], [], []
+        cond_func, cond_tags = e621dl.default_condition, []
+        if kind <= 3:
+            whitelist = [tags[i % len(tags)]]
+        elif kind == 4:
+            whitelist = [tags[i % len(tags)], tags[(i * 7 + 1) % len(tags)]]
+        elif kind <= 6:
+            anylist = [tags[(i + j * 31) % len(tags)] for j in range(4)]
+        elif kind == 7:
+            whitelist = [f'{tags[i % len(tags)][:-1]}*']
+        elif kind == 8:
+            template = CONDITIONS[i % len(CONDITIONS)]
+            condition = template.format(*(tags[(i + j * 13) % len(tags)] for j in range(4)))
+            source_template, cond_tags = local.tags_and_source_template(condition)
+            cond_func = local.make_check_funk(source_template, cond_tags)
+        else:
+            blacklist = [tags[(i * 3) % len(tags)]]
+
+        subdirectories = set()
+        if (i + 1) % depth:
+            subdirectories.add(f'section_{i + 1}')
+        if i % 10 == 0 and i + 5 < count:
+            subdirectories.add(f'section_{i + 5}')
+        if i % 50 == 7:
+            subdirectories.add(f'section_{i - 1}')
+
+        has_actual_search = e621dl.check_has_actual_search(whitelist, blacklist, anylist, cond_func)
+        directory = f'section_{i}'
+        searches_dict[directory] = {
+            'directory': directory,
+            'ratings': ['s', 'q', 'e'] if i % 4 else ['s'],
+            'min_score': -0x7F_FF_FF_FF if i % 5 else 10,
+            'min_favs': 0,
+            'days_ago': 3650 if i % 7 else 3,
+            'blacklist': filters.MaskList(blacklist),
+            'whitelist': filters.MaskList(whitelist),
+            'anylist': filters.MaskList(anylist),
+            'cond_func': cond_func,
+            'cond_tags': cond_tags,
+            'posts_countdown': float('inf'),
+            'format': '{artist}: {id}?' if i % 3 == 0 else '',
+            'subdirectories': subdirectories,
+            'has_actual_search': has_actual_search,
+        }
+    return searches_dict
+
+def tree_paths(node, path):
+    yield path
+    for child in node.children:
+        yield from tree_paths(child, f'{path}/{child.directory}')
+
+def time_rounds(func, rounds):
+    times = []
+    ops = 0
+    for dummy in range(rounds):
+        start = perf_counter()
+        ops = func()
+        times.append(perf_counter() - start)
+    median = statistics.median(times)
+    return {'rounds': rounds,
+            'ops': ops,
+            'min_s': min(times),
+            'max_s': max(times),
+            'mean_s': statistics.mean(times),
+            'median_s': median,
+            'stddev_s': statistics.stdev(times) if rounds > 1 else 0.0,
+            'us_per_op': median / ops * 1e6 if ops else 0.0,
+            }
+
+def make_benchmarks(args):
+    import e621dl
+    from e621dl_lib import filters, local, remote
+
+    corpus = Corpus(posts=args.posts, tags=args.tags, tags_per_post=args.tags_per_post, file_size=64)
+    raw_posts = [corpus.public(post) for post in corpus.posts]
+    metatags = ['order:id_desc']
+    posts = [remote.Post(post, metatags) for post in raw_posts]
+    chunks = [posts[i:i + CHUNK_POSTS] for i in range(0, len(posts), CHUNK_POSTS)]
+
+    searches_dict = make_searches(e621dl, filters, local, corpus.tag_names, args.sections, args.depth)
+    searches = list(searches_dict.values())
+    sample = searches[::max(1, len(searches) // args.sample_sections)]
+    conditions = [search['cond_func'] for search in searches if search['cond_tags']]
+    subfolder_tree = filters.compile_subfolders(searches_dict)
+    section_index = filters.SectionIndex(searches)
+
+    # Pairs the download loop would plan paths for, chunk by chunk
+    candidates = []
+    for chunk in chunks[:max(1, args.plan_posts // CHUNK_POSTS)]:
+        pairs = []
+        for search, found in zip(searches, section_index.match(chunk)):
+            pairs += [(search, post) for post in found]
+        candidates.append(pairs)
+
+    paths = [path for directory, node in subfolder_tree.items()
+             for path in tree_paths(node, directory)]
+    filenames = [f"{post.id}: {post.artist} <{post.rating}>?.{post.file_ext}" for post in posts]
+    path_pairs = [(paths[i % len(paths)], filename) for i, filename in enumerate(filenames)]
+
+    def post_init():
+        for post in raw_posts:
+            remote.Post(post, metatags)
+        return len(raw_posts)
+
+    def post_generate():
+        for post in posts:
+            post.generate()
+        return len(posts)
+
+    def process_result():
+        for search in sample:
+            for post in posts:
+                e621dl.process_result(post, **search)
+        return len(sample) * len(posts)
+
+    def process_results():
+        for search in sample:
+            for chunk in chunks:
+                e621dl.process_results(chunk, **search)
+        return len(sample) * len(posts)
+
+    def condition():
+        tagsets = [set(post.tags) for post in posts]
+        for cond_func in conditions:
+            for tags in tagsets:
+                cond_func(tags)
+        return len(conditions) * len(tagsets)
+
+    # Nodes are made on first visit, so the whole tree is walked
+    def compile_subfolders():
+        tree = filters.compile_subfolders(searches_dict)
+        return sum(1 for directory, node in tree.items() for path in tree_paths(node, directory))
+
+    def get_directories():
+        ops = 0
+        for pairs in candidates:
+            memo = {}
+            for search, post in pairs:
+                directory = search['directory']
+                e621dl.get_directories(post, subfolder_tree[directory], directory, memo)
+            ops += len(pairs)
+        return ops
+
+    def substitute_illegals_filename():
+        for filename in filenames:
+            local.substitute_illegals_filename(filename)
+        return len(filenames)
+
+    def make_path():
+        for directory, filename in path_pairs:
+            local.make_path(directory, filename)
+        return len(path_pairs)
+
+    workload = {'posts': len(posts),
+                'sections': len(searches),
+                'sample_sections': len(sample),
+                'conditions': len(conditions),
+                'subfolder_paths': len(paths),
+                'candidate_pairs': sum(len(pairs) for pairs in candidates),
+                }
+    benchmarks = {'post_init': post_init,
+                  'post_generate': post_generate,
+                  'process_result': process_result,
+                  'process_results': process_results,
+                  'condition': condition,
+                  'compile_subfolders': compile_subfolders,
+                  'get_directories': get_directories,
+                  'substitute_illegals_filename': substitute_illegals_filename,
+                  'make_path': make_path,
+                  }
+    return workload, benchmarks
+
+# The last saved run, it is read before this run is saved over it
+def previous_results():
+    filenames = glob.glob(os.path.join(RESULTS_DIR, 'micro-*.json'))
+    if not filenames:
+        return None
+    return max(filenames, key=os.path.getmtime)
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"\ncompared with {baseline['version']} ({baseline['revision']})")
+    if baseline['workload'] != results['workload']:
+        print('[!] workloads differ, numbers are not comparable')
+    print('benchmark                       before us/op   now us/op    change')
+    for name, result in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if not before or not before['us_per_op']:
+            continue
+        change = (result['us_per_op'] / before['us_per_op'] - 1) * 100
+        mark = ''
+        if change > threshold:
+            mark = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<30} {before['us_per_op']:>12.3f} {result['us_per_op']:>11.3f} {change:>+8.1f}%{mark}")
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='e621dl filtering and path planning micro-benchmarks')
+    parser.add_argument('--posts', type=int, default=10_000)
+    parser.add_argument('--sections', type=int, default=500)
+    parser.add_argument('--depth', type=int, default=25, help='length of subfolder chains')
+    parser.add_argument('--tags', type=int, default=2000)
+    parser.add_argument('--tags-per-post', type=int, default=30)
+    parser.add_argument('--sample-sections', type=int, default=50,
+                        help='sections process_result and process_results run over all posts with')
+    parser.add_argument('--plan-posts', type=int, default=2560,
+                        help='posts get_directories plans paths for against all sections')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--only', nargs='+', help='run only these benchmarks')
+    parser.add_argument('--compare', help='results file to compare with, the previous saved run by default')
+    parser.add_argument('--threshold', type=float, default=10, help='slowdown in percent to report')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args(args)
+
+    # e621dl keeps its state in the current folder from import on,
+    # and make_path creates folders
+    os.chdir(tempfile.mkdtemp(prefix='e621dl-micro-'))
+    from e621dl_lib import constants, local
+    local.printer.headless()
+
+    setup_start = perf_counter()
+    workload, benchmarks = make_benchmarks(args)
+    print(f"Setup in {perf_counter() - setup_start:.1f} s: " +
+          ', '.join(f'{value} {name}' for name, value in workload.items()))
+
+    if args.only:
+        unknown = set(args.only) - set(benchmarks)
+        if unknown:
+            parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+        benchmarks = {name: func for name, func in benchmarks.items() if name in args.only}
+
+    results = {'version': constants.VERSION,
+               'revision': git_revision(),
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'args': vars(args),
+               'workload': workload,
+               'benchmarks': {},
+               }
+    print('benchmark                            ops    median s   us/op   stddev s')
+    for name, func in benchmarks.items():
+        result = results['benchmarks'][name] = time_rounds(func, args.rounds)
+        print(f"{name:<30} {result['ops']:>9} {result['median_s']:>10.4f} "
+              f"{result['us_per_op']:>7.3f} {result['stddev_s']:>10.4f}")
+
+    filename = os.path.join(RESULTS_DIR, f"micro-{results['version']}-{results['revision']}.json")
+    baseline_filename = args.compare or previous_results()
+
+    regressions = []
+    if baseline_filename:
+        with open(baseline_filename) as infile:
+            regressions = compare(results, json.load(infile), args.threshold)
+
+    # Benchmarks left out with --only keep their numbers from the last run of this revision
+    if os.path.isfile(filename):
+        with open(filename) as infile:
+            saved = json.load(infile)
+        if saved['workload'] == results['workload']:
+            results['benchmarks'] = {**saved['benchmarks'], **results['benchmarks']}
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        with open(filename, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f'\nSaved to {os.path.relpath(filename, ROOT)}')
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
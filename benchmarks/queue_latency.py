@@ -0,0 +1,117 @@
+# Handoff latency between the API producer and the download loop.
+#
+# Compares DownloadQueue with the sleep polling it replaced:
+# producer spinning with sleep(0.0001) while the queue is full,
+# consumer sleeping 0.5 s whenever the queue is empty.
+#
+# Usage, from e621dl folder:
+#     python benchmarks/queue_latency.py [--chunks 200] [--produce-ms 5] [--consume-ms 2]
+
+# Internal Imports
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+from collections import deque
+from threading import Lock, Thread
+from time import perf_counter, process_time, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Personal Imports
+from e621dl_lib.local import DownloadQueue
+
+class PollingQueue:
+    # The old handoff, without journaling
+    def __init__(self, maxlen):
+        self._lock = Lock()
+        self._deque = deque()
+        self._seq = 0
+        self.maxlen = maxlen
+        self.aborted = False
+
+    def append(self, arg, last_id=None):
+        while True:
+            with self._lock:
+                if len(self._deque) < self.maxlen:
+                    break
+            sleep(0.0001)
+        with self._lock:
+            self._seq += 1
+            self._deque.append((self._seq, arg))
+
+    def wait_after(self, seq=None):
+        while True:
+            with self._lock:
+                for item in self._deque:
+                    if seq is None or item[0] > seq:
+                        return item
+            if self.aborted:
+                return None
+            sleep(0.5)
+
+    def done(self, seq):
+        with self._lock:
+            self._deque = deque(item for item in self._deque if item[0] != seq)
+
+def run(queue, chunks, produce_s, consume_s):
+    latencies = []
+
+    def produce():
+        for i in range(chunks):
+            sleep(produce_s)
+            queue.append(('bench', [perf_counter()]), last_id=i)
+        queue.aborted = True
+
+    start = perf_counter()
+    cpu_start = process_time()
+    producer = Thread(target=produce)
+    producer.start()
+    seq = None
+    while True:
+        item = queue.wait_after(seq)
+        if item is None:
+            break
+        seq, chunk = item
+        latencies.append(perf_counter() - chunk[1][0])
+        sleep(consume_s)
+        queue.done(seq)
+    producer.join()
+
+    return {'wall_s': perf_counter() - start,
+            'cpu_s': process_time() - cpu_start,
+            'median_ms': statistics.median(latencies) * 1000,
+            'max_ms': max(latencies) * 1000,
+            }
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='DownloadQueue handoff latency')
+    parser.add_argument('--chunks', type=int, default=200)
+    parser.add_argument('--maxlen', type=int, default=10)
+    parser.add_argument('--produce-ms', type=float, default=5,
+                        help='time to get one chunk from API')
+    parser.add_argument('--consume-ms', type=float, default=2,
+                        help='time to download one chunk')
+    args = parser.parse_args(args)
+
+    produce_s = args.produce_ms / 1000
+    consume_s = args.consume_ms / 1000
+
+    # Slow producer shows consumer latency, slow consumer shows producer spinning
+    for name, p, c in (('slow producer', produce_s, consume_s), ('slow consumer', consume_s, produce_s)):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = DownloadQueue(os.path.join(tmp, 'download_queue.db'))
+            queue.configure(args.maxlen, 0)
+            queue.aborted = False
+            results = {'polling': run(PollingQueue(args.maxlen), args.chunks, p, c),
+                       'condition': run(queue, args.chunks, p, c)}
+            queue.conn.close()
+
+        print(name)
+        for kind, result in results.items():
+            print(f"  {kind:<10} wall {result['wall_s']:7.2f} s  cpu {result['cpu_s']:6.2f} s  "
+                  f"latency median {result['median_ms']:8.2f} ms  max {result['max_ms']:8.2f} ms")
+
+if __name__ == '__main__':
+    sys.exit(main())
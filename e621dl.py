@@ -2,19 +2,25 @@
 # -*- coding: utf-8 -*-
 
 # Internal Imports
+import asyncio
 import os
-import re
 from distutils.version import StrictVersion
 from shutil import copy
-from threading import Thread
-from time import sleep
+from threading import Thread, Event
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from functools import partial
 from traceback import print_exc
 
 # Personal Imports
 from e621dl_lib import constants
+from e621dl_lib import downloader
+from e621dl_lib import filters
 from e621dl_lib import local
+from e621dl_lib import metrics
 from e621dl_lib import remote
+from e621dl_lib import tracing
 
 # External Imports
 
@@ -25,10 +31,79 @@ config_queue = local.ConfigQueue()
 
 storage = local.PostsStorage()
 download_set = local.ActiveDownloadsSet()
+downloads_in_flight = metrics.registry.gauge('e621dl_downloads_in_flight', 'Submitted downloads not finished yet')
 
 def is_prefilter(section_name):
     return 'prefilter' == section_name or ( section_name[0]=='<' and section_name[-1] == '>' )
 
+# Options of [Settings] that are needed before configs are processed,
+# read the same way for main() and process_config.
+# headless is None if it is not set.
+def read_settings(config):
+    settings = {'offline': False,
+                'api_key': None,
+                'login': None,
+                'tag_cache_days': constants.TAG_CACHE_DAYS,
+                'tag_cache_size': constants.TAG_CACHE_SIZE,
+                'api_rate': constants.API_RATE,
+                'api_burst': constants.API_BURST,
+                'trace_file': None,
+                'headless': None,
+                }
+    for section in config.sections():
+        if section.lower().strip() != 'settings':
+            continue
+        for option, value in config.items(section):
+            option = option.lower()
+            if option in {'full_offline', 'offline'}:
+                settings['offline'] = value.lower() == 'true'
+            elif option in {'password', 'api_key', 'key'}:
+                settings['api_key'] = value.strip().lower()
+            elif option in {'login', 'username', 'name'}:
+                settings['login'] = value.strip().lower()
+            elif option in {'tag_cache_days', 'tag_cache_ttl'}:
+                settings['tag_cache_days'] = float(value)
+            elif option in {'tag_cache_size'}:
+                settings['tag_cache_size'] = int(value)
+            elif option in {'api_rate', 'requests_per_second'}:
+                settings['api_rate'] = max(float(value), constants.MIN_API_RATE)
+            elif option in {'api_burst', 'requests_burst'}:
+                settings['api_burst'] = max(int(value), 1)
+            elif option in {'trace_file'}:
+                settings['trace_file'] = value.strip() or None
+            elif option in {'headless'}:
+                settings['headless'] = value.lower() == 'true'
+    return settings
+
+# Every tag process_config would check in a config file,
+# and its read_settings, with credentials and the tag cache
+# and API rate to check them with. Offline configs check nothing.
+def collect_config_tags(filename):
+    config, dummy_hash = local.get_config(filename)
+    settings = read_settings(config)
+    tags = []
+    if settings['offline']:
+        return tags, settings
+
+    for section in config.sections():
+        section_id = section.lower().strip()
+        if section_id in {'settings', 'defaults'}:
+            continue
+        for option, value in config.items(section):
+            option = option.lower()
+            if section_id == 'blacklist':
+                if option in {'tags', 'tag'}:
+                    tags += value.replace(',', ' ').lower().strip().split()
+            elif option in {'tags', 'tag', 'blacklist', 'blacklist_tags', 'blacklisted'}:
+                tags += value.replace(',', ' ').lower().strip().split()
+            elif option in {'condition', 'conditions'} and value.lower().strip():
+                tags += local.tags_and_source_template(value.lower().strip())[1]
+
+    return tags, settings
+
+def dont_append(posts):
+    pass
+
 def default_condition(x):
     return True
 
@@ -37,17 +112,18 @@ def check_has_actual_search(whitelist, blacklist, anylist, cond_func, **dummy):
     
 
 def process_result(post, whitelist, blacklist, anylist, cond_func, ratings, min_score, min_favs, days_ago, has_actual_search, **dummy):
-    tags = post.tags
-
     if not has_actual_search:
         return []
-    if whitelist and not all( any(reg.fullmatch(tag) for tag in tags) for reg in whitelist ):
+
+    tags = set(post.tags)
+
+    if whitelist and not whitelist.all_match(tags):
         return []
-    elif blacklist and any( any(reg.fullmatch(tag) for tag in tags) for reg in blacklist ):
+    elif blacklist and blacklist.any_match(tags):
         return []
-    elif anylist and not any(any(reg.fullmatch(tag) for tag in tags) for reg in anylist):
+    elif anylist and not anylist.any_match(tags):
         return []
-    elif not cond_func(set(tags)):
+    elif not cond_func(tags):
         return []
     elif post.rating not in ratings:
         return []
@@ -70,25 +146,28 @@ def process_results(results, **dummy):
     return filtered_results
 
 #TODO: describe how this all works. God this is not intuitive
-def get_directories(post, root_dirs, search, searches_dict):
-    subdirectories = search['subdirectories']
-    
+def get_directories(post, node, path, memo):
+    search = node.search
+
     # below lies recursion
     # Essentially we travel down the tree
-    # until we get to branch with no subbranches
+    # until we get to branch with no subbranches.
+    # The tree itself is compiled by filters.compile_subfolders,
+    # so cycles like cat/dog/cat/dog/... are already cut there
     results = []
-    
-    search_result = process_result(post, **search)
-    
+
+    # The same subcategory is usually shared by many sections,
+    # so every (post, section) check is made once per chunk
+    key = (post.id, node.directory)
+    search_result = memo.get(key)
+    if search_result is None:
+        search_result = memo[key] = bool(process_result(post, **search))
+
     # We travel below only if current folder matches
     # our criteria or there is nothing to look for
     if search_result or not search['has_actual_search']:
-        for directory in subdirectories:
-            #preventing recursions in cases like cat/dog/cat/dog/...
-            if directory in root_dirs:
-                continue
-
-            results += get_directories(post, root_dirs + [directory], searches_dict[directory], searches_dict)
+        for child in node.children:
+            results += get_directories(post, child, f'{path}/{child.directory}', memo)
     # And for each branch on the same level,
     # We check if we should place files there.
     # If we find matching folder on a deeper level
@@ -97,26 +176,33 @@ def get_directories(post, root_dirs, search, searches_dict):
     # If not, we check if current folder
     # matches and if it is, we place our file there
     if not results and search_result:
-        return ['/'.join(root_dirs)]
+        return [path]
     else:
         return results
     
 
-def get_files(post, filename, directories, files, session, cachefunc, duplicate_func, download_post, search, api_key, login):
-    with download_set.context_id(post.id):
+def get_files(post, filename, directories, files, session, cachefunc, duplicate_func, download_post, search, api_key, login, md5_cache=False):
+    with download_set.context_id(post.id), tracing.span('get files', 'download', id=post.id):
 
         
         for directory in directories:
             file_id=post.id
             path = local.make_path(directory, filename)
+            md5_path = remote.md5_cache_path(post.md5, post.file_ext)
 
             if os.path.isfile(path):
                 local.printer.increment_old()
             elif file_id in files:
                 duplicate_func(files[file_id], path)
                 local.printer.increment_copied()
+            elif md5_cache and os.path.isfile(md5_path):
+                # The same file under another post id
+                duplicate_func(md5_path, path)
+                files[file_id]=path
+                local.printer.increment_copied()
             else:
-                if download_post(post.file_url, path, session, cachefunc, duplicate_func, api_key, login):
+                if download_post(post.file_url, path, session, cachefunc, duplicate_func, api_key, login,
+                                 md5=post.md5, md5_cache=md5_cache):
                     files[file_id]=path
                     local.printer.increment_downloaded()
                 else:
@@ -124,47 +210,275 @@ def get_files(post, filename, directories, files, session, cachefunc, duplicate_
                     return search, False
         
         return search, True
+
+# Finds out what get_files_async has to do with a file. Runs in the executor as it touches the disk and files.db
+def locate_file(post, filename, directory, files, md5_cache):
+    path = local.make_path(directory, filename)
+    md5_path = remote.md5_cache_path(post.md5, post.file_ext)
+
+    if os.path.isfile(path):
+        return path, 'old', None
+    source = files.get(post.id)
+    if source is not None:
+        return path, 'copy', source
+    if md5_cache and os.path.isfile(md5_path):
+        # The same file under another post id
+        return path, 'md5', md5_path
+    return path, 'download', None
+
+# The same as get_files, but for AsyncDownloadPool
+async def get_files_async(download_pool, post, filename, directories, files, session, cachefunc, duplicate_func, download_post, search, api_key, login, md5_cache=False):
+    loop = asyncio.get_running_loop()
+    async with download_pool.slot(post.id), tracing.span('get files', 'download', id=post.id):
+
+        for directory in directories:
+            file_id=post.id
+            path, action, source = await loop.run_in_executor(None, locate_file, post, filename, directory, files, md5_cache)
+
+            if action == 'old':
+                local.printer.increment_old()
+            elif action == 'copy':
+                await loop.run_in_executor(None, duplicate_func, source, path)
+                local.printer.increment_copied()
+            elif action == 'md5':
+                await loop.run_in_executor(None, duplicate_func, source, path)
+                # FileIndex only keeps new rows in memory until flush(), so this does not block the loop
+                files[file_id]=path
+                local.printer.increment_copied()
+            else:
+                if await download_post(post.file_url, path, session, cachefunc, duplicate_func, api_key, login,
+                                       md5=post.md5, md5_cache=md5_cache):
+                    files[file_id]=path
+                    local.printer.increment_downloaded()
+                else:
+                    local.printer.increment_not_found()
+                    return search, False
+
+        return search, True
                 
+def fetch_section(kwargs, blocked_ids, searches, stop_event):
+    directory = kwargs['directory']
+    local.printer.change_section(directory)
+    gen = kwargs['gen_funcs']
+    append_func=kwargs['append_func']
+    max_days_ago=kwargs['days_ago']
+
+    # If posts are not stored, blocked and blacklisted
+    # ones can be dropped before they are even parsed
+    blacklist = kwargs['blacklist']
+    def raw_filter(post, metatags):
+        if post['id'] in blocked_ids:
+            return False
+        if blacklist:
+            tags = set(metatags)
+            for taglist in post['tags'].values():
+                tags.update(taglist)
+            return not blacklist.any_match(tags)
+        return True
+
+    if append_func is not dont_append:
+        raw_filter = None
+
+    # Every section is resumed from its own cursor
+    if download_queue.in_gens(directory):
+        return
+    last_id = download_queue.cursor(directory)
+    for results in gen(last_id, raw_filter=raw_filter, **kwargs):
+        local.printer.increment_posts(len(results))
+        append_func(results)
+        with tracing.span('filter page', 'filter', section=directory, posts=len(results)):
+            filtered_results=[post for post in results if post.id not in blocked_ids]
+            filtered_results=process_results(filtered_results, **kwargs)
+        local.printer.increment_filtered(len(set(results) - set(filtered_results)))
+
+        post=results[-1]
+        download_queue.append( (directory, filtered_results), last_id=post.id )
+        if post.days_ago >= max_days_ago:
+            break
+
+        if not any(s for s in searches if s['posts_countdown'] > 0):
+            break
+
+        if stop_event.is_set():
+            return
+    download_queue.completed_gen(directory)
+
+# Posts of a section wait here while all of its slots are taken
+# by downloads in flight: if one of them fails, its slot is free again
+class ChunkState:
+    __slots__ = ('seq', 'pending', 'memo')
+
+    def __init__(self, seq, pending):
+        self.seq = seq
+        self.pending = pending
+        self.memo = {}
+
+# Download loop. Chunks are taken from download_queue as soon as they come,
+# not after the previous one is finished, so one slow file does not stall
+# the others. All scheduling happens in this thread: chunks come from
+# a feeder thread, finished downloads from future callbacks, both through
+# one event queue, so a section slot (posts_countdown) is taken when a post
+# is submitted and given back right when it fails.
+# A chunk is removed from download_queue only when all its posts are done.
+def schedule_downloads(searches, section_index, subfolder_tree, pathes_storage, files, submit_post):
+    events = Queue()
+    in_flight = {}
+    deferred = {}
+
+    def feed():
+        seq = None
+        while True:
+            item = download_queue.wait_after(seq)
+            if item is None:
+                events.put(('end', None))
+                return
+            seq = item[0]
+            events.put(('chunk', item))
+
+    def finish(state):
+        state.pending -= 1
+        if state.pending == 0:
+            download_queue.done(state.seq)
+
+    # Paths are planned first and written in one short transaction after,
+    # so files.db is not locked while get_directories works
+    def save_pathes(planned):
+        if planned:
+            pathes_storage.begin()
+            for directories, filename in planned:
+                pathes_storage.add_pathes(directories, filename)
+            pathes_storage.commit()
+        # Paths downloaded since the last chunk, workers don't write to sqlite
+        files.flush()
+
+    def schedule(search, post, state, planned):
+        key = id(search)
+        if search['posts_countdown'] <= 0:
+            if in_flight.get(key):
+                deferred.setdefault(key, deque()).append((search, post, state))
+            else:
+                finish(state)
+            return
+
+        directory = search['directory']
+        directories = get_directories(post, subfolder_tree[directory], directory, state.memo)
+        if not directories:
+            local.printer.increment_filtered(1)
+            finish(state)
+            return
+
+        format = search['format']
+        if format:
+            id_ext = f'{post.id}.{post.file_ext}'
+            custom_prefix = format.format(**post.generate())[:100]
+            filename = f'{custom_prefix}.{id_ext}'
+        else:
+            filename = f'{post.id}.{post.file_ext}'
+
+        planned.append((directories, filename))
+        future = submit_post(search, post, filename, directories)
+        search['posts_countdown'] -= 1
+        in_flight[key] = in_flight.get(key, 0) + 1
+        downloads_in_flight.set(downloads_in_flight.value + 1)
+        future.add_done_callback(lambda future: events.put(('done', (future, search, state))))
+
+    def on_done(future, search, state):
+        key = id(search)
+        in_flight[key] -= 1
+        downloads_in_flight.set(downloads_in_flight.value - 1)
+        finish(state)
+        if future.exception():
+            raise future.exception()
+
+        search, success = future.result()
+        if not success:
+            search['posts_countdown'] += 1
+
+        waiting = deferred.get(key)
+        if waiting and search['posts_countdown'] > 0:
+            # Paths of deferred posts go in one transaction, as with a chunk
+            planned = []
+            while waiting and search['posts_countdown'] > 0:
+                schedule(*waiting.popleft(), planned)
+            save_pathes(planned)
+        if waiting and not in_flight[key]:
+            # Section is full for good
+            while waiting:
+                finish(waiting.popleft()[2])
+
+    def on_chunk(seq, chunk):
+        chunk_directory, chunk = chunk
+        results_pair = []
+        filter_span = tracing.span('filter chunk', 'filter', section=chunk_directory, posts=len(chunk))
+        if is_prefilter(chunk_directory.lower()):
+            # One pass over the chunk instead of every post against every search
+            for search, posts in zip(searches, section_index.match(chunk)):
+                if search['posts_countdown'] > 0:
+                    local.printer.increment_filtered(len(chunk) - len(posts))
+                results_pair += list(zip([search]*len(posts), posts))
+        else:
+            for search in searches:
+                directory = search['directory']
+                if chunk_directory.lower() != directory.lower():
+                    continue
+
+                results_pair += list(zip([search]*len(chunk), chunk))
+        filter_span.end()
+
+        # One more for the chunk itself, so it is not done before all posts are scheduled
+        state = ChunkState(seq, len(results_pair) + 1)
+        with tracing.span('plan paths', 'filter', section=chunk_directory, pairs=len(results_pair)):
+            planned = []
+            for search, post in results_pair:
+                schedule(search, post, state, planned)
+            save_pathes(planned)
+        finish(state)
+
+    Thread(target=feed, daemon=True).start()
+    feeding = True
+    while feeding or any(in_flight.values()):
+        kind, item = events.get()
+        if kind == 'chunk':
+            on_chunk(*item)
+        elif kind == 'done':
+            on_done(*item)
+        else:
+            feeding = False
+
 #@profile
-def prefilter_build_index(kwargses, use_db, searches):
+def prefilter_build_index(kwargses, use_db, searches, concurrent_searches=1):
     
     if use_db:
         storage.connect()
     
     blocked_ids = local.get_blocked_posts()
+    stop_event = Event()
     
     try:
         if download_queue.completed:
             return
         
-        last_id = download_queue.last_id
-        
-        for kwargs in kwargses:
-
-            directory = kwargs['directory']
-            local.printer.change_section(directory)
-            gen = kwargs['gen_funcs']
-            append_func=kwargs['append_func']
-            max_days_ago=kwargs['days_ago']
-            
-            for results in gen(last_id, **kwargs):
-                local.printer.increment_posts(len(results))
-                append_func(results)
-                filtered_results=[post for post in results if post.id not in blocked_ids]
-                filtered_results=process_results(filtered_results, **kwargs)
-                local.printer.increment_filtered(len(set(results) - set(filtered_results)))
-                
-                download_queue.append( (directory, filtered_results) )
-                post=results[-1]
-                download_queue.last_id=post.id
-                if post.days_ago >= max_days_ago:
-                    break
-                
-                if not any(s for s in searches if s['posts_countdown'] > 0):
-                    break
-            last_id = None
-            download_queue.completed_gen(directory)
+        if concurrent_searches <= 1:
+            for kwargs in kwargses:
+                fetch_section(kwargs, blocked_ids, searches, stop_event)
+        else:
+            # Sections are fetched in parallel, but each one still
+            # puts its chunks into download_queue in order
+            # and keeps its own resume cursor
+            with ThreadPoolExecutor(max_workers=concurrent_searches) as fetch_pool:
+                futures = [fetch_pool.submit(fetch_section, kwargs, blocked_ids, searches, stop_event)
+                           for kwargs in kwargses]
+                try:
+                    for future in futures:
+                        future.result()
+                except:
+                    stop_event.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
         download_queue.completed = True
+    except local.QueueClosed:
+        pass
     except HTTPError as e:
         local.printer.show(False)
         local.printer.stop()
@@ -188,15 +502,28 @@ def prefilter_build_index(kwargses, use_db, searches):
           
           
 def main():
-    #local.printer.show(False)
+    # Nothing is drawn until headless is known
+    local.printer.show(False)
     local.printer.start()
     local.save_on_exit_events(download_queue.save)
     current_configs = local.get_configs()
     config_queue.change_if_not_same(current_configs)
     config_queue.reset_if_complete()
+
+    # One pass over all configs before anything is drawn or requested:
+    # tags to check, and settings that cover the whole run
+    collected = [collect_config_tags(config) for config in config_queue.get_remaining()]
+
+    # tracing and headless from [Settings] of any config
+    trace_file = next((settings['trace_file'] for tags, settings in collected if settings['trace_file']), None)
+    if trace_file:
+        tracing.start(trace_file)
+    local.printer.headless(any(settings['headless'] for tags, settings in collected))
+    local.printer.show()
     
-    local.printer.change_status("Building downloaded files dict")
-    files = local.get_files_dict(config_queue.reset_filedb)
+    local.printer.change_status("Updating downloaded files index")
+    with tracing.span('file index refresh', 'files'):
+        files = local.get_files_dict(config_queue.reset_filedb)
     
     
     pathes_storage=local.PathesStorage()
@@ -206,6 +533,24 @@ def main():
     prune_cache = False
     
     with remote.requests_retry_session() as session:
+        session.headers['User-Agent'] = f"e621dl (lurkbbs) -- Version {constants.VERSION}"
+
+        # All tags of all configs are checked in batches first,
+        # process_config then gets them from the tag cache
+        local.printer.change_status("Checking tags")
+        tags_by_user = {}
+        for tags, settings in collected:
+            if tags:
+                key = tuple(settings[name] for name in ('api_key', 'login', 'tag_cache_days',
+                                                        'tag_cache_size', 'api_rate', 'api_burst'))
+                tags_by_user.setdefault(key, []).extend(tags)
+        for (api_key, login, tag_cache_days, tag_cache_size, api_rate, api_burst), tags in tags_by_user.items():
+            # The same cache and rate process_config would check these tags with
+            remote.tag_cache.configure(tag_cache_days, tag_cache_size)
+            remote.api_limiter.configure(api_rate, api_burst)
+            with tracing.span('resolve tags', 'tags', tags=len(tags)):
+                remote.prefetch_tag_aliases(tags, api_key, login, session)
+
         for config in config_queue.get_remaining():
             config_name = '/'.join(config.replace('\\','/').split('/')[1:])
             local.printer.change_config(config_name)
@@ -221,19 +566,21 @@ def main():
 
     if prune_downloads:
         local.printer.change_status("Pruning downloads")
-        pathes_storage.remove_old()
+        pathes_storage.remove_old(files)
     
     if prune_cache:
         local.printer.change_status("Pruning cache")
-        local.prune_cache()
+        local.prune_cache(files)
     
     local.printer.change_status("Removing empty folders")
-    local.remove_empty_folders()
+    local.remove_empty_folders(files)
 
     local.printer.change_status("All complete")
     local.printer.stop()
     local.printer.join()
     local.printer.step()
+    metrics.stop_export()
+    tracing.stop()
     
     
 
@@ -250,8 +597,10 @@ def process_config(filename, session, files, pathes_storage):
     session.headers['User-Agent'] = f"e621dl (lurkbbs) -- Version {constants.VERSION}"
     
     local.printer.change_status("Parsing config")
+    parse_span = tracing.span('parse config', 'config', config=filename)
 
     config, hash = local.get_config(filename)
+    settings = read_settings(config)
     download_queue.check_config_hash(hash)
     download_queue.aborted = False
 
@@ -273,11 +622,12 @@ def process_config(filename, session, files, pathes_storage):
     
     duplicate_func = copy
     cachefunc = None
+    md5_cache = False
     prefilter = []
     max_days_ago = default_days_ago
     cond_func = lambda x: True
     default_gen_func = remote.get_posts
-    default_append_func = lambda x: None
+    default_append_func = dont_append
     
     get_tag_alias = remote.get_tag_alias
     download_post = remote.download_post
@@ -287,14 +637,30 @@ def process_config(filename, session, files, pathes_storage):
     full_offline = False
     prune_downloads = False
     prune_cache = False
-    api_key = None
-    login = None
+    api_key = settings['api_key']
+    login = settings['login']
+    download_engine = 'threads'
+    concurrent_downloads = 2
+    prefetch_pages = 0
+    post_class = remote.Post
+    stream_posts = False
+    concurrent_searches = 1
+    remote.api_limiter.configure(settings['api_rate'], settings['api_burst'])
+    remote.tag_cache.configure(settings['tag_cache_days'], settings['tag_cache_size'])
+    if settings['headless'] is not None:
+        local.printer.headless(settings['headless'])
+    metrics_file = None
+    metrics_format = 'json'
+    metrics_interval = 10.0
+    queue_chunks = constants.QUEUE_CHUNKS
+    queue_bytes = constants.QUEUE_BYTES
+    download_queue.configure(queue_chunks, queue_bytes)
     # Iterate through all sections (lines enclosed in brackets: []).
     for section in config.sections():
 
         make_cache_flag=False
-        # Get values from the "Settings" section. Currently only used for file name appending.
-        if section.lower() == 'settings':
+        # Get values from the "Settings" section. Options main() needs as well are in read_settings.
+        if section.lower().strip() == 'settings':
             for option, value in config.items(section):
                 if option.lower() == 'include_md5':
                     if value.lower() == 'true':
@@ -302,10 +668,18 @@ def process_config(filename, session, files, pathes_storage):
                 elif option.lower() == 'make_hardlinks':
                     if value.lower() == 'true':
                         duplicate_func = os.link
+                elif option.lower() in {'fast_copy', 'reflinks'}:
+                    # Hardlinks win if both are set
+                    if value.lower() == 'true' and duplicate_func is copy:
+                        duplicate_func = local.fast_copy
                 elif option.lower() == 'make_cache':
                     if value.lower() == 'true':
                         local.make_cache_folder()
                         make_cache_flag=True
+                elif option.lower() in {'md5_cache'}:
+                    if value.lower() == 'true':
+                        os.makedirs(constants.MD5_CACHE_DIR, exist_ok=True)
+                        md5_cache = True
                 elif option.lower() in {'maintain_db','db','use_db','database', 'maintain_database' }:
                     if value.lower() == 'true':
                         default_append_func = storage.append
@@ -317,28 +691,55 @@ def process_config(filename, session, files, pathes_storage):
                 elif option.lower() in {'prune_cache'}:
                     if value.lower() == 'true':
                         prune_cache = True                
-                elif option.lower() in {'password', 'api_key', 'key'}:
-                        api_key = value.strip().lower()
-                elif option.lower() in {'login', 'username', 'name'}:
-                        login = value.strip().lower()
-                
-        if section.lower() == 'settings':
-            for option, value in config.items(section):
-                if option.lower() in {'full_offline', 'offline'}:
+                elif option.lower() in {'download_engine', 'engine'}:
+                    if value.strip().lower() in downloader.DOWNLOAD_ENGINES:
+                        download_engine = value.strip().lower()
+                    else:
+                        local.printer.change_warning(f"Unknown download engine: {value}")
+                elif option.lower() in {'concurrent_downloads', 'download_workers', 'workers'}:
+                    concurrent_downloads = max(int(value), 1)
+                elif option.lower() in {'prefetch_pages', 'prefetch'}:
+                    prefetch_pages = max(int(value), 0)
+                elif option.lower() in {'stream_posts'}:
                     if value.lower() == 'true':
-                        default_gen_func=storage.gen
-                        default_append_func = lambda x: None
-                        
-                        get_tag_alias = lambda _tag, _api_key, _login, _session: _tag
-                        download_post = lambda _file_url, _path, _session, _cachefunc, _duplicate_func, _api_key, _login : False
-                        
-                        use_db = True
-                        allow_append = False
-                        full_offline = True
+                        stream_posts = True
+                elif option.lower() in {'lazy_posts'}:
+                    if value.lower() == 'true':
+                        post_class = remote.LazyPost
+                elif option.lower() in {'concurrent_searches', 'search_workers'}:
+                    concurrent_searches = max(int(value), 1)
+                elif option.lower() in {'metrics_file'}:
+                    metrics_file = value.strip() or None
+                elif option.lower() in {'metrics_format'}:
+                    if value.strip().lower() in metrics.METRICS_FORMATS:
+                        metrics_format = value.strip().lower()
+                    else:
+                        local.printer.change_warning(f"Unknown metrics format: {value}")
+                elif option.lower() in {'metrics_interval'}:
+                    metrics_interval = max(float(value), 0.1)
+                elif option.lower() in {'queue_chunks'}:
+                    queue_chunks = max(int(value), 0)
+                elif option.lower() in {'queue_mb', 'queue_megabytes'}:
+                    queue_bytes = max(int(float(value) * 1024 * 1024), 0)
+                
+            if settings['offline']:
+                default_gen_func=storage.gen
+                default_append_func = dont_append
+                
+                get_tag_alias = remote.get_local_tag_alias
+                download_post = lambda _file_url, _path, _session, _cachefunc, _duplicate_func, _api_key, _login, **_kwargs : False
+                
+                use_db = True
+                allow_append = False
+                full_offline = True
 
             if make_cache_flag:
                 cachefunc = duplicate_func
 
+            download_queue.configure(queue_chunks, queue_bytes)
+            if metrics_file:
+                metrics.start_export(metrics_file, metrics_format, metrics_interval)
+
         # Get values from the "Defaults" section. This overwrites the initialized default_* variables.
         elif section.lower() == 'defaults':
             for option, value in config.items(section):
@@ -362,7 +763,7 @@ def process_config(filename, session, files, pathes_storage):
                 elif option.lower() in {'posts_from', 'posts_func', 'posts_source', 'post_from','post_func', 'post_source'}:
                     if value.lower() in {'db','database','local'}:
                         default_gen_func=storage.gen
-                        default_append_func = lambda x: None
+                        default_append_func = dont_append
                         use_db = True
                 elif option.lower() in {'subfolder', 'subfolders', 'subdir', 'subdirs', 'subdirectory', 'subdirectories'}:
                     default_subdirectories.update( value.replace(',', ' ').lower().strip().split() )
@@ -431,6 +832,7 @@ def process_config(filename, session, files, pathes_storage):
             section_favs = default_favs
             section_ratings = default_ratings
             section_cond_func = default_condition
+            section_cond_tags = []
             section_blacklist = []
             section_whitelist = []
             section_anylist = []
@@ -481,32 +883,37 @@ def process_config(filename, session, files, pathes_storage):
                         source_template, tags = local.tags_and_source_template(value.lower().strip())
                         tags = [get_tag_alias(tag.lower(), api_key, login, session) for tag in tags]
                         section_cond_func = local.make_check_funk(source_template, tags)
+                        section_cond_tags = tags
                 elif option.lower() in {'posts_from', 'posts_func', 'posts_source', 'post_from', 'post_func', 'post_source'}:
                     if value.lower() in {'db','database','local'}:
                         section_gen_func=storage.gen
-                        section_append_func = lambda x: None
+                        section_append_func = dont_append
                         use_db = True
                     elif not full_offline:
                         section_gen_func=remote.get_posts
                         if allow_append:
                             section_append_func = storage.append
             
+            if section_gen_func is remote.get_posts and prefetch_pages:
+                section_gen_func = remote.prefetching(remote.get_posts, prefetch_pages)
+
             section_tags += ['-'+tag for tag in blacklist+section_blacklisted]
             #section_search_tags = [tag for tag in section_tags if '*' not in tag][:38]
             section_search_tags = section_tags[:constants.MAX_USER_SEARCH_TAGS]
-            section_blacklist=[re.compile(re.escape(mask).replace('\\*','.*')) for mask in section_blacklist+section_blacklisted]
-            section_whitelist=[re.compile(re.escape(mask).replace('\\*','.*')) for mask in section_whitelist]
-            section_anylist = [re.compile(re.escape(mask).replace('\\*','.*')) for mask in section_anylist]
-            
+            section_blacklist += section_blacklisted
+
             section_has_actual_search = \
                 check_has_actual_search(section_whitelist, section_blacklist, section_anylist, section_cond_func)
             if section_has_actual_search and use_default_subfolders:
                 section_subdirectories.update(default_subdirectories)
             # Append the final values that will be used for the specific section to the list of searches.
             # Note section_tags is a list within a list.
-            
-            section_blacklist +=[re.compile(re.escape(mask).replace('\\*','.*')) for mask in blacklist]
-            
+
+            # Masks are compiled once per section here, process_result only does lookups
+            section_blacklist = filters.MaskList(section_blacklist + blacklist)
+            section_whitelist = filters.MaskList(section_whitelist)
+            section_anylist = filters.MaskList(section_anylist)
+
             if section_id[0] == "*":
                 section_directory = section_id[1:]
             else:
@@ -523,12 +930,15 @@ def process_config(filename, session, files, pathes_storage):
                              'whitelist': section_whitelist, 
                              'anylist': section_anylist,
                              'cond_func': section_cond_func,
+                             'cond_tags': section_cond_tags,
                              'gen_funcs': section_gen_func,
                              'append_func': section_append_func,
                              'posts_countdown': section_post_limit,
                              'format':section_format,
                              'subdirectories': section_subdirectories,
                              'session'  : session,
+                             'post_class': post_class,
+                             'stream_posts': stream_posts,
                              'has_actual_search': section_has_actual_search,
                              'login': login,
                              'api_key': api_key,}
@@ -540,11 +950,12 @@ def process_config(filename, session, files, pathes_storage):
                 if section_id[0] != "*":
                     searches.append(section_dict)
 
+    parse_span.end()
     local.printer.change_tag("all tags are valid")
     local.printer.change_status("Checking for partial downloads")
 
     if not full_offline:
-        remote.finish_partial_downloads(session, cachefunc, duplicate_func, api_key, login)
+        remote.finish_partial_downloads(session, cachefunc, duplicate_func, api_key, login, files, md5_cache)
     
     
     
@@ -555,82 +966,41 @@ def process_config(filename, session, files, pathes_storage):
     else:
         kwargs = [search for search in searches if not download_queue.in_gens(search['directory'])]
 
+    section_index = filters.SectionIndex(searches)
+    subfolder_tree = filters.compile_subfolders(searches_dict)
+
     local.printer.change_status("Downloading files")
-    queue_thread=Thread(target=prefilter_build_index, args=(kwargs, use_db, searches))
+    queue_thread=Thread(target=prefilter_build_index, args=(kwargs, use_db, searches, concurrent_searches))
     queue_thread.start()
     
-    download_pool=ThreadPoolExecutor(max_workers=2)
-    
-    try:
-        while True:
-            try:
-                chunk_directory, chunk = download_queue.first()
-            except:
-            
-                if download_queue.aborted:
-                    break
-                else:
-                    sleep(0.5)
-                    continue
+    if download_engine == 'async' and downloader.aiohttp is None:
+        local.printer.change_warning("aiohttp is not installed, using threads for downloads")
+        download_engine = 'threads'
+
+    # Offline mode has nothing to download, no need for an event loop
+    if download_engine == 'async' and not full_offline:
+        download_pool = downloader.AsyncDownloadPool(concurrent_downloads, session.headers)
+        get_files_func = partial(get_files_async, download_pool)
+        download_session = download_pool.session
+        download_post = remote.download_post_async
+    else:
+        download_pool = ThreadPoolExecutor(max_workers=concurrent_downloads)
+        download_set.resize(concurrent_downloads)
+        get_files_func = get_files
+        download_session = session
+
+    local.printer.start_download_clock()
     
-            results_pair = []
-            for search in searches:
-                directory = search['directory']
-                if chunk_directory.lower() != directory.lower() and not is_prefilter(chunk_directory.lower()):
-                    continue
+    def submit_post(search, post, filename, directories):
+        return download_pool.submit(get_files_func,
+            post, filename, directories, files,
+            download_session, cachefunc, duplicate_func, download_post, search, api_key, login, md5_cache)
 
-                results_pair += list(zip([search]*len(chunk), chunk))
-            
-            while results_pair:
-                futures = []
-                remaining_from_countdown=[]
-                
-                pathes_storage.begin()
-                for search, post in results_pair:
-                    directory = search['directory']
-                    format = search['format']
-                    if search['posts_countdown'] <= 0:
-                        remaining_from_countdown.append( (search, post) )
-                        continue
-                    
-                    directories = get_directories(post, [directory], search, searches_dict)
-                    if directories:
-                        if format:
-                            id_ext = f'{post.id}.{post.file_ext}'
-                            custom_prefix = format.format(**post.generate())[:100]
-                            filename = f'{custom_prefix}.{id_ext}'
-                        else:
-                            filename = f'{post.id}.{post.file_ext}'
-                        
-                        pathes_storage.add_pathes(directories, filename)
-                        futures.append(download_pool.submit(get_files,
-                            post, filename, directories, files,
-                            session, cachefunc, duplicate_func, download_post, search, api_key, login))
-                        
-                        search['posts_countdown'] -= 1
-                    else:
-                        local.printer.increment_filtered(1)
-                pathes_storage.commit()
-                
-                for future in futures:
-                    if future.exception():
-                        raise future.exception()
-                    
-                    #Recovering wrong countdown decrement
-                    #Still not good and may lead to less post than
-                    #max_posts. But better than it was
-                    search, success = future.result()
-                    if not success:
-                        search['posts_countdown'] += 1
-                
-                results_pair = []
-                for search, post in remaining_from_countdown:
-                    if search['posts_countdown'] > 0:
-                        results_pair.append(search, post)
-                    
-            download_queue.popleft()
+    try:
+        schedule_downloads(searches, section_index, subfolder_tree, pathes_storage, files, submit_post)
 
     except: #Pull request a better way
+        download_queue.close()
         local.printer.show(False)
         local.printer.stop()
         local.printer.join()
@@ -638,9 +1008,12 @@ def process_config(filename, session, files, pathes_storage):
         print("Exception during download:")
         print_exc()
         download_queue.save()
+        tracing.save()
         os._exit(0)
     
     queue_thread.join()
+    download_pool.shutdown()
+    files.flush()
     
     if download_queue.completed:
         download_queue.reset()
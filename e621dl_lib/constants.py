@@ -8,6 +8,41 @@ PARTIAL_DOWNLOAD_EXT = 'request'
 #aka (connect timeout, read timeout)
 CONNECTION_TIMEOUT = (6.1, 15.5)
 
+# Default limits for e621 API requests,
+# requests per second and how many can go at once
+API_RATE = 1.0
+API_BURST = 1
+# Lowest api_rate accepted, one request in 100 seconds
+MIN_API_RATE = 0.01
+
+# Checked tags are remembered in tags.db for this many days,
+# and no more than this many of them
+TAG_CACHE_DAYS = 7
+TAG_CACHE_SIZE = 100_000
+
+# How many tags are checked with one request
+TAG_BATCH_SIZE = 100
+
+# Posts imported from database export in one transaction
+EXPORT_BATCH_SIZE = 50_000
+
+# How many chunks of posts and how many bytes of them
+# can wait for downloads, 0 is no limit
+QUEUE_CHUNKS = 10
+QUEUE_BYTES = 0
+
+# Threads that list folders of cache/ and downloads/ at once
+SCAN_WORKERS = 8
+
+# How long a write to files.db waits for another one, in ms
+SQLITE_BUSY_MS = 30_000
+
+# How much of a download the async engine collects before writing it out
+ASYNC_WRITE_BUFFER = 1 << 20
+
+# Files by their content, as {md5}.{ext}
+MD5_CACHE_DIR = 'cache/md5'
+
 MAX_USER_SEARCH_TAGS = 38 #one for time tag, one for id tag
 
 # 'author' is a field I just don't know anything about
@@ -0,0 +1,67 @@
+# Internal Imports
+import asyncio
+from contextlib import asynccontextmanager
+from threading import Thread
+
+# Personal Imports
+from . import constants
+
+# Optional Imports
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+DOWNLOAD_ENGINES = {'threads', 'async'}
+
+class AsyncDownloadPool:
+    # Drop-in for ThreadPoolExecutor in the download loop:
+    # submit() returns a concurrent.futures.Future, but the work
+    # is a coroutine running on one event loop in a background thread.
+    # Up to max_workers files are transferred at once.
+    def __init__(self, max_workers, headers):
+        self.max_workers = max_workers
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._active_ids = {}
+        self.session = self._run(self._open_session(headers))
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _open_session(self, headers):
+        # Semaphore must be created inside of the loop it is used in
+        self._semaphore = asyncio.Semaphore(self.max_workers)
+        connect_timeout, read_timeout = constants.CONNECTION_TIMEOUT
+        return aiohttp.ClientSession(
+            headers = dict(headers),
+            connector = aiohttp.TCPConnector(limit = self.max_workers),
+            timeout = aiohttp.ClientTimeout(total = None, sock_connect = connect_timeout, sock_read = read_timeout),
+        )
+
+    # Async counterpart of ActiveDownloadsSet.context_id:
+    # limits number of concurrent transfers and never lets
+    # the same post to be downloaded twice at the same time
+    @asynccontextmanager
+    async def slot(self, id):
+        while id in self._active_ids:
+            await self._active_ids[id].wait()
+
+        event = self._active_ids[id] = asyncio.Event()
+        try:
+            async with self._semaphore:
+                yield
+        finally:
+            del self._active_ids[id]
+            event.set()
+
+    def submit(self, coro_func, *args):
+        return asyncio.run_coroutine_threadsafe(coro_func(*args), self._loop)
+
+    def shutdown(self, wait=True):
+        self._run(self.session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if wait:
+            self._thread.join()
+        self._loop.close()
@@ -0,0 +1,144 @@
+# Import of e621 database exports, https://e621.net/db_export/
+#
+# Usage, from e621dl folder:
+#     python -m e621dl_lib.exports posts posts-2020-07-08.csv.gz
+#     python -m e621dl_lib.exports tags tags-2020-07-08.csv.gz
+#     python -m e621dl_lib.exports aliases tag_aliases-2020-07-08.csv.gz
+
+# Internal Imports
+import argparse
+import csv
+import gzip
+import sys
+from time import time
+
+# Personal Imports
+from . import constants
+from .local import PostsStorage
+from .remote import LazyPost, tag_cache
+
+# Descriptions can be long, way longer than csv default limit
+csv.field_size_limit(2**31 - 1)
+
+def open_export(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8', newline='')
+    return open(filename, 'rt', encoding='utf-8', newline='')
+
+def export_date(text):
+    # '2020-03-06 13:47:53.354371' in UTC
+    text = text.replace(' ', 'T')
+    if '+' not in text[10:] and not text.endswith('Z'):
+        text += '+00:00'
+    return text
+
+def file_url(md5, ext):
+    return f'https://static1.e621.net/data/{md5[0:2]}/{md5[2:4]}/{md5}.{ext}'
+
+# posts.json-like dict from a row of posts export.
+# Export has no tag categories and no pools,
+# so all tags are general ones and {artist} is empty.
+def post_from_export(row):
+    md5 = row['md5']
+    ext = row['file_ext']
+    return {
+        'id': int(row['id']),
+        'created_at': export_date(row['created_at']),
+        'tags': {'general': row['tag_string'].split(), 'artist': []},
+        'rating': row['rating'],
+        'file': {'md5': md5,
+                 'ext': ext,
+                 'url': file_url(md5, ext),
+                 'size': int(row['file_size'] or 0),
+                 'width': int(row['image_width'] or 0),
+                 'height': int(row['image_height'] or 0),
+                 },
+        'score': {'total': int(row['score'] or 0),
+                  'up': int(row['up_score'] or 0),
+                  'down': int(row['down_score'] or 0),
+                  },
+        'fav_count': int(row['fav_count'] or 0),
+        'sources': row['source'].split('\n') if row['source'] else [],
+        'description': row['description'],
+        'pools': [],
+        'uploader_id': int(row['uploader_id'] or 0),
+    }
+
+def import_posts(filename, replace=False, batch_size=constants.EXPORT_BATCH_SIZE):
+    storage = PostsStorage()
+    storage.connect()
+
+    imported = 0
+    start = time()
+
+    def flush(batch):
+        nonlocal imported
+        if not replace:
+            # Posts from API have tag categories and pools, keeping them
+            existing = storage.existing_ids([post.id for post in batch])
+            batch = [post for post in batch if post.id not in existing]
+        storage.append(batch, commit=False)
+        imported += len(batch)
+
+    try:
+        with open_export(filename) as infile:
+            batch = []
+            for row in csv.DictReader(infile):
+                if row['is_deleted'] == 't':
+                    continue
+                batch.append(LazyPost(post_from_export(row), []))
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+                    storage.commit()
+                    print(f"{imported} posts imported, {imported / (time() - start):.0f} posts/s")
+            flush(batch)
+            storage.commit()
+    finally:
+        storage.close()
+
+    print(f"Done, {imported} posts imported")
+    return imported
+
+def import_tags(filename):
+    with open_export(filename) as infile:
+        count = tag_cache.replace_known_tags(
+            (row['name'], int(row['category'] or 0), int(row['post_count'] or 0))
+            for row in csv.DictReader(infile) )
+    print(f"Done, {count} tags imported")
+    return count
+
+def import_aliases(filename):
+    with open_export(filename) as infile:
+        count = tag_cache.replace_known_aliases(
+            (row['antecedent_name'], row['consequent_name'])
+            for row in csv.DictReader(infile) if row['status'] == 'active' )
+    print(f"Done, {count} aliases imported")
+    return count
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m e621dl_lib.exports',
+                                     description='Imports e621 database exports into local databases.')
+    subparsers = parser.add_subparsers(dest='kind', required=True)
+
+    posts_parser = subparsers.add_parser('posts', help='posts-*.csv.gz into posts.db')
+    posts_parser.add_argument('filename')
+    posts_parser.add_argument('--replace', action='store_true',
+                              help='replace posts that are already in posts.db')
+
+    tags_parser = subparsers.add_parser('tags', help='tags-*.csv.gz into tags.db')
+    tags_parser.add_argument('filename')
+
+    aliases_parser = subparsers.add_parser('aliases', help='tag_aliases-*.csv.gz into tags.db')
+    aliases_parser.add_argument('filename')
+
+    args = parser.parse_args(args)
+    if args.kind == 'posts':
+        import_posts(args.filename, args.replace)
+    elif args.kind == 'tags':
+        import_tags(args.filename)
+    elif args.kind == 'aliases':
+        import_aliases(args.filename)
+
+if __name__ == '__main__':
+    sys.exit(main())
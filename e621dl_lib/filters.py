@@ -0,0 +1,143 @@
+# Internal Imports
+import re
+
+def mask_to_regex(mask):
+    # '*' is the only wildcard e621 supports in tag masks
+    return re.escape(mask).replace('\\*','.*')
+
+class MaskList:
+    # A compiled list of tag masks, e.g. ['cat', 'dog*', '*_ears'].
+    # Literal tags are checked with set lookups and all wildcard
+    # masks are merged into one regex, so a post is matched with
+    # one pass over its tags instead of one pass per mask.
+    __slots__ = ('masks', 'literals', 'wildcards', 'combined')
+
+    def __init__(self, masks=()):
+        self.masks = list(dict.fromkeys(masks))
+        self.literals = frozenset(mask for mask in self.masks if '*' not in mask)
+
+        wildcard_masks = [mask for mask in self.masks if '*' in mask]
+        self.wildcards = [re.compile(mask_to_regex(mask)) for mask in wildcard_masks]
+        if wildcard_masks:
+            self.combined = re.compile('|'.join(f'(?:{mask_to_regex(mask)})' for mask in wildcard_masks))
+        else:
+            self.combined = None
+
+    def __bool__(self):
+        return bool(self.masks)
+
+    # True if at least one mask matches at least one tag
+    def any_match(self, tagset):
+        if not self.literals.isdisjoint(tagset):
+            return True
+        if self.combined is not None:
+            fullmatch = self.combined.fullmatch
+            return any(fullmatch(tag) for tag in tagset)
+        return False
+
+    # True if every mask matches at least one tag
+    def all_match(self, tagset):
+        if not self.literals <= tagset:
+            return False
+        # Every wildcard needs its own witness tag,
+        # so these can't be merged into one regex
+        for reg in self.wildcards:
+            fullmatch = reg.fullmatch
+            if not any(fullmatch(tag) for tag in tagset):
+                return False
+        return True
+
+# Tags a post must have at least one of to match a section,
+# or None if there is no such set and the section must always be checked
+def index_keys(whitelist, anylist, cond_func, cond_tags, has_actual_search, **dummy):
+    if not has_actual_search:
+        return None
+    if whitelist.literals:
+        # Every whitelisted tag is required, one is enough for a key.
+        # Longer tags tend to be rarer, so fewer false candidates
+        return [max(whitelist.literals, key=lambda tag: (len(tag), tag))]
+    if anylist and not anylist.wildcards:
+        return list(anylist.literals)
+    # A condition only looks at its own tags, so a post with none of them
+    # is evaluated exactly like an empty tag set
+    if cond_tags and not cond_func(frozenset()):
+        return list(cond_tags)
+    return None
+
+class SectionIndex:
+    # Inverted tag -> section index over all searches of a config.
+    # It only rules out sections that can't possibly match a post,
+    # the remaining candidates are still checked with process_result.
+    def __init__(self, searches):
+        self.searches = list(searches)
+        self._by_tag = {}
+        self._always = []
+
+        for section_id, search in enumerate(self.searches):
+            keys = index_keys(**search)
+            if keys is None:
+                self._always.append(section_id)
+                continue
+            for tag in keys:
+                self._by_tag.setdefault(tag, []).append(section_id)
+
+    # For every search, in order, a list of candidate posts in chunk order
+    def match(self, posts):
+        hits = [[] for dummy in self.searches]
+        by_tag = self._by_tag
+
+        for post in posts:
+            found = set()
+            for tag in set(post.tags):
+                section_ids = by_tag.get(tag)
+                if section_ids:
+                    found.update(section_ids)
+            for section_id in found:
+                hits[section_id].append(post)
+
+        for section_id in self._always:
+            hits[section_id] = list(posts)
+
+        return hits
+
+class SubfolderNode:
+    __slots__ = ('directory', 'search', 'path', '_nodes', '_children')
+
+    def __init__(self, directory, path, nodes):
+        self.directory = directory
+        self.search = nodes.searches_dict[directory]
+        self.path = path
+        self._nodes = nodes
+        self._children = None
+
+    # Built on first visit: get_directories goes below a folder only
+    # if the post matches it, so most of the tree is never needed
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = [self._nodes.get(subdirectory, self.path | {subdirectory})
+                              for subdirectory in self.search['subdirectories']
+                              if subdirectory not in self.path]
+        return self._children
+
+class _SubfolderNodes:
+    def __init__(self, searches_dict):
+        self.searches_dict = searches_dict
+        self._nodes = {}
+
+    def get(self, directory, path):
+        key = (directory, path)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = SubfolderNode(directory, path, self)
+        return node
+
+# Unfolds subfolder options of all sections into a tree for every section.
+# A subfolder that is already on the path is skipped, so cat/dog/cat/...
+# cycles are cut here once instead of on every post. Subtrees that
+# have the same set of folders above them are identical and are shared.
+# There is a node for every simple path, with many shared subfolders that
+# is far too many to build, so nodes are only made when they are visited.
+def compile_subfolders(searches_dict):
+    nodes = _SubfolderNodes(searches_dict)
+    return {directory: nodes.get(directory, frozenset([directory])) for directory in searches_dict}
@@ -6,32 +6,57 @@ import atexit
 import sys
 from threading import Thread, Lock, Condition
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import sqlite3
 import pickle
-from time import sleep
+from time import sleep, time
 from functools import lru_cache
 import hashlib
-from shutil import get_terminal_size, move
+from shutil import get_terminal_size, move, copy, copymode
 from contextlib import contextmanager, suppress
 import glob
 import re
 
+# Optional Imports
+try:
+    import fcntl
+except ImportError: #win
+    fcntl = None
+
 # External Imports
 import colorama
 from natsort import natsorted
 
 # Personal Imports
 from . import constants
+from . import metrics
+from . import tracing
 
 class StatPrinter(Thread):
+    # Counters are kept in metrics, so increments are cheap from any thread
+    # and can be exported. The screen is redrawn only when something changed,
+    # and not at all in headless mode.
+    COUNTERS = {'connection retries': ('e621dl_connection_retries_total', 'Retried connections'),
+                'posts so far': ('e621dl_posts_total', 'Post infos received'),
+                'already exist': ('e621dl_files_existing_total', 'Files that were already in place'),
+                'downloaded': ('e621dl_files_downloaded_total', 'Downloaded files'),
+                'copied': ('e621dl_files_copied_total', 'Files copied or linked from other folders'),
+                'filtered': ('e621dl_posts_filtered_total', 'Posts that matched no section'),
+                'not found on e621': ('e621dl_files_not_found_total', 'Files that could not be downloaded'),
+                }
+
     def __init__(self):
         super().__init__(daemon=True)
 
         colorama.init()
-        self.messages = deque()
-        self._increments = deque()
         self._show = True
+        self._headless = False
         self._is_running = True
+        self._bytes_since = None
+        self._last_frame = None
+        self._counters = {line: metrics.registry.counter(name, help)
+                          for line, (name, help) in self.COUNTERS.items()}
+        self._bytes = metrics.registry.counter('e621dl_bytes_downloaded_total', 'Downloaded bytes')
         
         self.lines = {'status' : 'Just starting',
                       'checked tag' : 'None so far',
@@ -44,6 +69,7 @@ class StatPrinter(Thread):
                       'already exist': 0,
                       'downloaded' : 0,
                       'copied' : 0,
+                      'downloaded size' : 0,
                       'filtered' : 0,
                       'not found on e621' : 0,
                       }
@@ -52,22 +78,26 @@ class StatPrinter(Thread):
         self._is_running = False
         
     def step(self):
-        while self.messages:
-            self.lines.update(self.messages.popleft())
-        
-        while self._increments:
-            k, v = self._increments.popleft()
-            self.lines[k] += v
-            
+        for line, counter in self._counters.items():
+            self.lines[line] = counter.value
+
+        downloaded = self._bytes.value
+        if downloaded:
+            elapsed = max(time() - self._bytes_since, 0.001)
+            megabytes = downloaded / 1024 / 1024
+            self.lines['downloaded size'] = f"{megabytes:.1f} MB, {megabytes / elapsed:.2f} MB/s"
         
-        if not self._show:
+        if not self._show or self._headless:
             return
-            
+
         columns = get_terminal_size((80, 20)).columns
+        frame = [f"{k}: {'None so far' if v == 0 else v}"[:columns] for k, v in self.lines.items()]
+        if frame == self._last_frame:
+            return
+
         self.reset_screen()
-        for k,v in self.lines.items():
-            v = 'None so far' if v == 0 else v
-            print(f"{k}: {v}"[:columns])
+        print('\n'.join(frame))
+        self._last_frame = frame
 
     def run(self):
 
@@ -76,51 +106,67 @@ class StatPrinter(Thread):
             sleep(0.5)
            
     def reset_screen(self):
+        if self._headless:
+            return
+        self._last_frame = None
         print("\033[1J\033[1;1H", end='')
 
     def change_status(self, text):
-        self.messages.append({'status' : text})
+        self.lines['status'] = text
 
     def change_tag(self, text):
-        self.messages.append({'checked tag' : text})
+        self.lines['checked tag'] = text
     
     def change_file(self, text):
-        self.messages.append({'recent file downloaded' : text})
+        self.lines['recent file downloaded'] = text
 
     def change_config(self, text):
-        self.messages.append({'current config' : text})
+        self.lines['current config'] = text
     
     def change_section(self, text):
-        self.messages.append({'current section' : text})
+        self.lines['current section'] = text
     
     def change_warning(self, text):
-        self.messages.append({'recent warning' : text})
+        self.lines['recent warning'] = text
     
     def increment_retries(self):
-        self._increments.append(('connection retries', 1))
+        self._counters['connection retries'].inc()
     
     def increment_downloaded(self):
-        self._increments.append(('downloaded', 1))
+        self._counters['downloaded'].inc()
     
     def increment_copied(self):
-        self._increments.append(('copied' , 1))
+        self._counters['copied'].inc()
     
     def increment_not_found(self):
-        self._increments.append(('not found on e621' , 1))
+        self._counters['not found on e621'].inc()
 
     def increment_old(self):
-        self._increments.append(('already exist' , 1))    
+        self._counters['already exist'].inc()
+
+    # Download speed is counted from the first call
+    def start_download_clock(self):
+        if self._bytes_since is None:
+            self._bytes_since = time()
+
+    def increment_bytes(self, amount):
+        self.start_download_clock()
+        self._bytes.inc(amount)
 
     def increment_posts(self, amount):
-        self._increments.append(('posts so far' , amount))
+        self._counters['posts so far'].inc(amount)
     
     def increment_filtered(self, amount):
-        self._increments.append(('filtered' , amount))
+        self._counters['filtered'].inc(amount)
     
     
     
     def show(self, val = True):
         self._show = val
+
+    # Nothing is drawn at all, e.g. for cron or systemd runs
+    def headless(self, val = True):
+        self._headless = val
         
 
 printer = StatPrinter()
@@ -131,6 +177,11 @@ class ActiveDownloadsSet:
         self._active_downloads = set()
         self._max_downloads = max_downloads
         
+    def resize(self, max_downloads):
+        with self._cv:
+            self._max_downloads = max_downloads
+            self._cv.notify_all()
+
     def add_id(self, id):
         def _predicate():
             return (len(self._active_downloads) < self._max_downloads
@@ -153,86 +204,220 @@ class ActiveDownloadsSet:
         finally:
             self.remove_id(id)
             
+class QueueClosed(Exception):
+    pass
+
+queued_chunks = metrics.registry.gauge('e621dl_queued_chunks', 'Chunks of posts waiting for downloads')
+
 class DownloadQueue:
-    def __init__(self):
+    # Chunks of posts on their way from API to downloads. Every chunk is
+    # journaled into download_queue.db when it comes and when it goes,
+    # together with a resume cursor of its section. Each change is one
+    # small WAL transaction, so a run killed in any way loses at most
+    # the chunk being appended, and nothing grows with queue size.
+    # Producer and consumer wait for each other on a condition variable:
+    # append() blocks while the queue is full, in chunks or in bytes,
+    # wait_after() blocks while there is nothing new.
+    def __init__(self, filename='download_queue.db'):
         self._lock = Lock()
-        
+        self._cv = Condition(self._lock)
+        self.filename = filename
+        self.max_chunks = constants.QUEUE_CHUNKS
+        self.max_bytes = constants.QUEUE_BYTES
+        self._bytes = 0
+        self._aborted = False
+        self._closed = False
+
         try:
             self.load()
-        except:
-            self.reset()
-
-        self.aborted = False
+        except sqlite3.DatabaseError:
+            # Broken journal, starting over
+            with suppress(AttributeError):
+                self.conn.close()
+            for suffix in ('', '-wal', '-shm'):
+                with suppress(FileNotFoundError):
+                    os.remove(filename + suffix)
+            self.load()
 
-    def popleft(self):
-        with self._lock:
-            return self._deque.popleft()
+    # 0 means no limit
+    def configure(self, max_chunks, max_bytes):
+        with self._cv:
+            self.max_chunks = max_chunks
+            self.max_bytes = max_bytes
+            self._cv.notify_all()
 
-    def append(self, arg, maxlen=10):
-        while True:
-            with self._lock:
-                if len(self._deque) < maxlen:
-                    break
-            sleep(0.0001)
-        
-        with self._lock:
-            return self._deque.append(arg)
-    
-    def save(self):
-        with self._lock:
-            with open('download_queue.pickle', 'wb') as download_queue_file:
-                pickle.dump((
-                             self.last_id,
-                             self.completed,
-                             self._deque,
-                             self.completed_deque,
-                             self.config_hash
-                            ), download_queue_file, protocol=pickle.HIGHEST_PROTOCOL)
-                
     def load(self):
         with self._lock:
-            with open('download_queue.pickle', 'rb') as download_queue_file:
-                (self.last_id,
-                 self.completed,
-                 self._deque,
-                 self.completed_deque,
-                 self.config_hash) = pickle.load(download_queue_file)
-    
-    def last(self):
-        with self._lock:
-            return self._deque[-1]
+            self.conn = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            # Durable against a killed process, a commit is not an fsync
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(
+                '''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key   TEXT PRIMARY KEY
+                               NOT NULL,
+                    value
+                ) WITHOUT ROWID;
+
+                CREATE TABLE IF NOT EXISTS chunks (
+                    seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+                    directory TEXT NOT NULL,
+                    posts     BLOB NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS cursors (
+                    directory TEXT PRIMARY KEY
+                                   NOT NULL,
+                    last_id   INTEGER NOT NULL,
+                    completed INTEGER NOT NULL
+                ) WITHOUT ROWID;'''
+            )
+            self._deque = deque(
+                (seq, (directory, pickle.loads(posts)), len(posts))
+                for seq, directory, posts in self.conn.execute('SELECT seq, directory, posts FROM chunks ORDER BY seq'))
+            self._bytes = sum(size for seq, chunk, size in self._deque)
+            queued_chunks.set(len(self._deque))
+            meta = dict(self.conn.execute('SELECT key, value FROM meta'))
+            self._completed = bool(meta.get('completed', False))
+            self._config_hash = meta.get('config_hash')
+
+    def _set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?,?);', (key, value))
 
-    def first(self):
+    @property
+    def completed(self):
+        return self._completed
+
+    @completed.setter
+    def completed(self, value):
         with self._lock:
-            return self._deque[0]
+            self._completed = value
+            self._set_meta('completed', int(value))
+
+    # Set by the producer when it has nothing more to append
+    @property
+    def aborted(self):
+        return self._aborted
+
+    @aborted.setter
+    def aborted(self, value):
+        with self._cv:
+            self._aborted = value
+            if value:
+                self._cv.notify_all()
+            else:
+                self._closed = False
+
+    # Consumer is gone, producers waiting in append() give up
+    def close(self):
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+
+    @property
+    def config_hash(self):
+        return self._config_hash
+
+    def _is_full(self):
+        # A chunk bigger than max_bytes still goes into an empty queue
+        if not self._deque:
+            return False
+        if self.max_chunks and len(self._deque) >= self.max_chunks:
+            return True
+        return bool(self.max_bytes) and self._bytes >= self.max_bytes
+
+    # last_id is the new resume cursor of the chunk section,
+    # it is journaled in the same transaction as the chunk
+    def append(self, arg, last_id=None):
+        directory, posts = arg
+        blob = pickle.dumps(posts, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._cv:
+            self._cv.wait_for(lambda: self._closed or not self._is_full())
+            if self._closed:
+                raise QueueClosed()
+            journal_span = tracing.span('journal chunk', 'db', section=directory, posts=len(posts))
+            self.conn.execute("BEGIN;")
+            seq = self.conn.execute('INSERT INTO chunks (directory, posts) VALUES (?,?);',
+                                    (directory, blob)).lastrowid
+            if last_id is not None:
+                self.conn.execute('INSERT OR REPLACE INTO cursors VALUES (?,?,0);', (directory, last_id))
+            self.conn.execute("COMMIT;")
+            journal_span.end()
+            self._deque.append((seq, arg, len(blob)))
+            self._bytes += len(blob)
+            queued_chunks.set(len(self._deque))
+            self._cv.notify_all()
+
+    # Everything is journaled as it happens. Kept for exit handlers,
+    # which must not wait for the lock: they can interrupt its holder
+    def save(self):
+        pass
     
+    # Waits for the first chunk that came after the one with seq,
+    # (seq, chunk) or None if there are no more of them
+    def wait_after(self, seq=None):
+        def find():
+            for item_seq, chunk, size in self._deque:
+                if seq is None or item_seq > seq:
+                    return item_seq, chunk
+            return None
+
+        with self._cv:
+            self._cv.wait_for(lambda: find() or self._aborted or self._closed)
+            if self._closed:
+                return None
+            return find()
+
+    # Chunks can be finished in any order, resume only needs the rest
+    def done(self, seq):
+        with self._cv:
+            for item in self._deque:
+                if item[0] == seq:
+                    self._deque.remove(item)
+                    self._bytes -= item[2]
+                    break
+            queued_chunks.set(len(self._deque))
+            self.conn.execute('DELETE FROM chunks WHERE seq=?;', (seq,))
+            self._cv.notify_all()
+
     def reset(self):
-        self._deque=deque()
-        self.completed=False
-        self.last_id = 0x7F_FF_FF_FF
-        self.completed_deque=deque()
-        try:
-            self.config_hash #checking if hash exists
-        except:
-            self.config_hash=None
-        
-    def is_reset(self):
-        return self.last_id == 0x7F_FF_FF_FF
-       
+        with self._cv:
+            self._deque = deque()
+            self._bytes = 0
+            self._cv.notify_all()
+            queued_chunks.set(len(self._deque))
+            self._completed = False
+            self.conn.executescript(
+                '''
+                BEGIN;
+                DELETE FROM chunks;
+                DELETE FROM cursors;
+                DELETE FROM meta WHERE key='completed';
+                COMMIT;'''
+            )
+
+    # Where to continue a section from
+    def cursor(self, name):
+        with self._lock:
+            row = self.conn.execute('SELECT last_id FROM cursors WHERE directory=?;', (name,)).fetchone()
+        return row[0] if row else 0x7F_FF_FF_FF
+
     def completed_gen(self, name):
         with self._lock:
-            self.completed_deque.append(name)
-            self.last_id = 0x7F_FF_FF_FF
+            self.conn.execute('INSERT OR REPLACE INTO cursors VALUES (?,?,1);', (name, 0x7F_FF_FF_FF))
     
     def check_config_hash(self, hash):
-        with self._lock:
-            if self.config_hash != hash:
-                self.reset()
-                self.config_hash = hash
+        if self._config_hash != hash:
+            self.reset()
+            with self._lock:
+                self._config_hash = hash
+                self._set_meta('config_hash', hash)
             
     def in_gens(self, name):
         with self._lock:
-            return name in self.completed_deque
+            row = self.conn.execute('SELECT completed FROM cursors WHERE directory=?;', (name,)).fetchone()
+        return bool(row and row[0])
 
 class ConfigQueue:
     def __init__(self):
@@ -286,21 +471,65 @@ class ConfigQueue:
         with self._lock:
             return natsorted(self.config_set - self.completed_set)
 
+POSTS_SCHEMA_VERSION = 1
+
 class PostsStorage:
+    # Posts are stored pickled in `posts`, so they can be restored as is.
+    # Fields used by filters are also stored in real columns of `post_info`,
+    # and tags in `post_tags`, so gen() can skip posts that can't match
+    # without unpickling them.
     def __init__(self):
-        pass
+        # Sections can be fetched from several threads at once
+        self._lock = Lock()
+        self._tag_ids = {}
     
-    def append(self, posts):
-        self.cur.executemany('INSERT OR REPLACE INTO posts VALUES (?,?)',
-            ( (post.id, pickle.dumps(post, protocol = pickle.HIGHEST_PROTOCOL) ) for post in posts) )
-        self.conn.commit()
+    def append(self, posts, commit=True):
+        with self._lock, tracing.span('store posts', 'db', posts=len(posts)):
+            self.cur.executemany('INSERT OR REPLACE INTO posts VALUES (?,?)',
+                ( (post.id, pickle.dumps(post, protocol = pickle.HIGHEST_PROTOCOL) ) for post in posts) )
+            self._index(posts)
+            if commit:
+                self.conn.commit()
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+
+    def existing_ids(self, ids):
+        existing = set()
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                self.cur.execute(f'SELECT id FROM posts WHERE id IN ({",".join("?"*len(chunk))})', chunk)
+                existing.update(row[0] for row in self.cur.fetchall())
+        return existing
+
+    def _intern_tags(self, names):
+        new_names = [name for name in names if name not in self._tag_ids]
+        if not new_names:
+            return
+        self.cur.executemany('INSERT OR IGNORE INTO tags (name) VALUES (?)', ((name,) for name in new_names))
+        for i in range(0, len(new_names), 500):
+            chunk = new_names[i:i+500]
+            self.cur.execute(f'SELECT name, id FROM tags WHERE name IN ({",".join("?"*len(chunk))})', chunk)
+            self._tag_ids.update(self.cur.fetchall())
+
+    def _index(self, posts):
+        self._intern_tags(list({tag for post in posts for tag in post.tags}))
+        self.cur.executemany('INSERT OR REPLACE INTO post_info VALUES (?,?,?,?,?,?)',
+            ( (post.id, post.rating, int(post.score), int(post.fav_count), post.created_at['s'], post.file_ext)
+              for post in posts ) )
+        self.cur.executemany('DELETE FROM post_tags WHERE post_id=?', ((post.id,) for post in posts))
+        tag_ids = self._tag_ids
+        self.cur.executemany('INSERT OR IGNORE INTO post_tags VALUES (?,?)',
+            ( (tag_ids[tag], post.id) for post in posts for tag in set(post.tags) ) )
         
     def close(self):
         self.cur.close()
         self.conn.close()
         
     def connect(self):
-        self.conn = sqlite3.connect('posts.db')
+        self.conn = sqlite3.connect('posts.db', check_same_thread=False)
         self.cur = self.conn.cursor()
         self.cur.executescript(
             '''CREATE TABLE IF NOT EXISTS posts (
@@ -308,22 +537,247 @@ class PostsStorage:
                                UNIQUE
                                NOT NULL,
                 struct BLOB
-            ) WITHOUT ROWID;'''
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS post_info (
+                id         INTEGER PRIMARY KEY
+                                   NOT NULL,
+                rating     TEXT,
+                score      INTEGER,
+                fav_count  INTEGER,
+                created_at INTEGER,
+                file_ext   TEXT
+            );
+
+            CREATE TABLE IF NOT EXISTS tags (
+                id   INTEGER PRIMARY KEY,
+                name TEXT UNIQUE
+                          NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS post_tags (
+                tag_id  INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                PRIMARY KEY (tag_id, post_id)
+            ) WITHOUT ROWID;
+
+            CREATE INDEX IF NOT EXISTS post_tags_post ON post_tags (post_id);'''
         )
         self.conn.commit()
         self.cur.arraysize=constants.MAX_RESULTS
-        
-    def gen(self, last_id, **dummy):
-        self.cur.execute('SELECT struct FROM posts WHERE id<=? ORDER BY id DESC', (last_id,))
-        results=[pickle.loads(result[0]) for result in self.cur.fetchmany()]
-        #TODO: recreate days_ago based on created_at
-        while results:
+
+        self.cur.execute('PRAGMA user_version')
+        if self.cur.fetchone()[0] < POSTS_SCHEMA_VERSION:
+            self._build_index()
+
+    # One time indexing of a database made by older versions
+    def _build_index(self):
+        printer.change_status("Indexing posts database")
+        read_cur = self.conn.cursor()
+        read_cur.arraysize = 10_000
+        read_cur.execute('SELECT struct FROM posts')
+        rows = read_cur.fetchmany()
+        while rows:
+            self._index([pickle.loads(row[0]) for row in rows])
+            rows = read_cur.fetchmany()
+        read_cur.close()
+        self.cur.execute(f'PRAGMA user_version = {POSTS_SCHEMA_VERSION}')
+        self.conn.commit()
+
+    # Filters of a section as SQL. Only posts process_result
+    # would reject anyway are skipped here, everything else
+    # is still checked in python.
+    # Returns None if nothing can match.
+    def _where(self, last_id, ratings=None, min_score=None, min_favs=None, days_ago=None, whitelist=None):
+        where = ['posts.id<=?']
+        params = [last_id]
+
+        if ratings:
+            where.append(f'post_info.rating IN ({",".join("?"*len(ratings))})')
+            params += ratings
+        if min_score is not None:
+            where.append('post_info.score>=?')
+            params.append(min_score)
+        if min_favs is not None:
+            where.append('post_info.fav_count>=?')
+            params.append(min_favs)
+        if days_ago is not None:
+            # One second for rounding, exact check is in process_result
+            where.append('post_info.created_at>?')
+            params.append(int(time() - days_ago * 86400) - 1)
+        if whitelist:
+            for tag in sorted(whitelist.literals):
+                self.cur.execute('SELECT id FROM tags WHERE name=?', (tag,))
+                row = self.cur.fetchone()
+                if row is None:
+                    return None
+                where.append('posts.id IN (SELECT post_id FROM post_tags WHERE tag_id=?)')
+                params.append(row[0])
+
+        return ' AND '.join(where), params
+
+    def gen(self, last_id, ratings=None, min_score=None, min_favs=None, days_ago=None, whitelist=None, **dummy):
+        if last_id is None:
+            last_id = 0x7F_FF_FF_FF
+
+        # Every generator has its own cursor, so they don't mix results
+        with self._lock:
+            condition = self._where(last_id, ratings, min_score, min_favs, days_ago, whitelist)
+            if condition is None:
+                return
+            where, params = condition
+
+            cur = self.conn.cursor()
+            cur.arraysize=constants.MAX_RESULTS
+            cur.execute(f'''SELECT posts.struct FROM posts
+                JOIN post_info ON post_info.id=posts.id
+                WHERE {where} ORDER BY posts.id DESC''', params)
+            rows = cur.fetchmany()
+        while rows:
+            now = time()
+            results = [pickle.loads(row[0]) for row in rows]
+            # days_ago is stored as it was when post was requested
+            for post in results:
+                post.days_ago = int(now - post.created_at['s'])/86400
             yield results
-            results=[pickle.loads(result[0]) for result in self.cur.fetchmany()]
+            with self._lock:
+                rows = cur.fetchmany()
+        cur.close()
+
+class TagAliasCache:
+    # Persistent tag -> actual tag cache for get_tag_alias,
+    # so tags are not checked on e621 on every run.
+    # Entries older than ttl_days are checked again,
+    # and only max_size most recently checked tags are kept.
+    # Tags and aliases imported from e621 database export
+    # are also looked up here, they never expire.
+    def __init__(self, filename='tags.db'):
+        self.filename = filename
+        self.conn = None
+        self._lock = Lock()
+        self._memory = {}
+        self._puts = 0
+        self.configure(constants.TAG_CACHE_DAYS, constants.TAG_CACHE_SIZE)
+
+    def configure(self, ttl_days, max_size):
+        with self._lock:
+            self.ttl = ttl_days * 86400
+            self.max_size = max_size
+
+    def connect(self):
+        if self.conn is not None:
+            return
+        self.conn = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+        self.conn.executescript(
+            '''CREATE TABLE IF NOT EXISTS aliases (
+                tag     TEXT PRIMARY KEY
+                             NOT NULL,
+                alias   TEXT NOT NULL,
+                checked REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS aliases_checked ON aliases (checked);
+
+            CREATE TABLE IF NOT EXISTS known_tags (
+                name       TEXT PRIMARY KEY
+                                NOT NULL,
+                category   INTEGER,
+                post_count INTEGER
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS known_aliases (
+                antecedent TEXT PRIMARY KEY
+                                NOT NULL,
+                consequent TEXT NOT NULL
+            ) WITHOUT ROWID;'''
+        )
+        self._update_has_known()
+        self._trim()
+
+    # Either import alone is enough to look tags up
+    def _update_has_known(self):
+        self._has_known = self.conn.execute('''SELECT EXISTS (SELECT 1 FROM known_tags)
+                                                   OR EXISTS (SELECT 1 FROM known_aliases)''').fetchone()[0]
+
+    def _trim(self):
+        self.conn.execute('''DELETE FROM aliases WHERE tag IN (
+            SELECT tag FROM aliases ORDER BY checked DESC LIMIT -1 OFFSET ?)''', (self.max_size,))
+
+    def _known(self, tag):
+        if not self._has_known:
+            return None
+        if '*' in tag:
+            # A mask is only checked to match some tag, it is kept as is:
+            # it is matched against post tags and sent to e621 as a mask.
+            # '*' is the same in GLOB, '[' and '?' are not
+            pattern = tag.replace('[', '[[]').replace('?', '[?]')
+            row = self.conn.execute('SELECT name FROM known_tags WHERE name GLOB ? LIMIT 1', (pattern,)).fetchone()
+            return tag if row else None
+        row = self.conn.execute('SELECT name FROM known_tags WHERE name=?', (tag,)).fetchone()
+        if row:
+            return tag
+        row = self.conn.execute('SELECT consequent FROM known_aliases WHERE antecedent=?', (tag,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, tag):
+        with self._lock:
+            if tag in self._memory:
+                return self._memory[tag]
+            self.connect()
+            row = None
+            if self.ttl > 0:
+                row = self.conn.execute('SELECT alias FROM aliases WHERE tag=? AND checked>=?',
+                                        (tag, time() - self.ttl)).fetchone()
+            actual_tag = row[0] if row else self._known(tag)
+            if actual_tag is not None:
+                self._memory[tag] = actual_tag
+            return actual_tag
+
+    # rows are (name, category, post_count)
+    def replace_known_tags(self, rows):
+        with self._lock:
+            self.connect()
+            self.conn.execute("BEGIN;")
+            self.conn.execute("DELETE FROM known_tags;")
+            self.conn.executemany('INSERT OR REPLACE INTO known_tags VALUES (?,?,?)', rows)
+            self.conn.execute("COMMIT;")
+            self._update_has_known()
+            return self.conn.execute('SELECT count(*) FROM known_tags').fetchone()[0]
+
+    # rows are (antecedent, consequent)
+    def replace_known_aliases(self, rows):
+        with self._lock:
+            self.connect()
+            self.conn.execute("BEGIN;")
+            self.conn.execute("DELETE FROM known_aliases;")
+            self.conn.executemany('INSERT OR REPLACE INTO known_aliases VALUES (?,?)', rows)
+            self.conn.execute("COMMIT;")
+            self._update_has_known()
+            return self.conn.execute('SELECT count(*) FROM known_aliases').fetchone()[0]
+
+    def put_many(self, pairs):
+        pairs = list(pairs)
+        with self._lock:
+            self._memory.update(pairs)
+            if self.ttl <= 0:
+                return
+            self.connect()
+            now = time()
+            self.conn.execute("BEGIN;")
+            self.conn.executemany('INSERT OR REPLACE INTO aliases VALUES (?,?,?)',
+                                  ((tag, alias, now) for tag, alias in pairs))
+            self.conn.execute("COMMIT;")
+            self._puts += len(pairs)
+            if self._puts >= 256:
+                self._puts = 0
+                self._trim()
+
+    def put(self, tag, alias):
+        self.put_many([(tag, alias)])
 
 class PathesStorage:
     def __init__(self):
         self.conn = sqlite3.connect('files.db', isolation_level=None)
+        self.conn.execute(f'PRAGMA busy_timeout={constants.SQLITE_BUSY_MS}')
         self.cur = self.conn.cursor()
     
     def begin(self):
@@ -346,14 +800,16 @@ class PathesStorage:
     def make_path(self, dir_name, filename):
         return f"downloads/{self.make_new_dir(dir_name)}/{substitute_illegals_filename(filename)}"
 
-    def remove_old(self):
+    def remove_old(self, files):
         self.cur.execute('''
             SELECT fullpath FROM old_files
             EXCEPT
             SELECT fullpath FROM new_files;''')
-        for (filename, ) in self.cur:
+        removed = [filename for (filename, ) in self.cur]
+        for filename in removed:
             with suppress(FileNotFoundError):
                 os.remove(filename)
+        files.discard(removed)
 
 _handler_gc_protection = [] #in case of lambdas
 
@@ -556,6 +1012,44 @@ def make_new_dir(dir_name):
 def make_path(dir_name, filename):
     return f"downloads/{make_new_dir(dir_name)}/{substitute_illegals_filename(filename)}"
 
+# ioctl of Linux for reflink clones, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+def _reflink(fsrc, fdst):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return False
+    return True
+
+def _copy_range(fsrc, fdst):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    left = os.fstat(fsrc.fileno()).st_size
+    try:
+        while left > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), left)
+            if copied == 0:
+                return False
+            left -= copied
+    except OSError:
+        return False
+    return True
+
+# Drop-in for shutil.copy as duplicate_func. File data is not moved
+# through userspace: a reflink clone shares it on btrfs, xfs and the like,
+# and copy_file_range lets the kernel (or NFS/SMB server) copy it.
+# If neither works, it is shutil.copy anyway.
+def fast_copy(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        done = _reflink(fsrc, fdst) or _copy_range(fsrc, fdst)
+    if not done:
+        return copy(src, dst)
+    copymode(src, dst)
+    return dst
+
 def make_cache_folder():
     try:
         os.mkdir("cache")
@@ -564,25 +1058,248 @@ def make_cache_folder():
     
 IMAGE_MATCH =  re.compile(r".*?(\d+?)\.(?:jpg|png|gif|swf|webm)")
     
-def get_files_dict(reset_filedb):
-    #args = [arg.strip().lower() for arg in sys.argv]
-    filedict={}
+# Walks folder trees in parallel, each folder is listed only once.
+# visit(item) is called in a pool thread for every item,
+# and returns items for subfolders it wants to go into
+def scan_dirs(items, visit, max_workers=constants.SCAN_WORKERS):
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(visit, item) for item in items}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.update(pool.submit(visit, item) for item in future.result())
 
-    for root, dirs, files in os.walk('cache/'):
-        for file in files:
-            try:
-                id=file.split('.')[-2] #id section
-                id=int(id)
-                filepath='{}/{}'.format(root.replace('\\','/').lower(),file)
-                filedict[id]=filepath
-            except (IndexError,ValueError):
-                pass
-                    
-    conn = sqlite3.connect('files.db', isolation_level=None)
-    cur = conn.cursor()
+# (folder, filename) of every file below root
+def list_files(root, max_workers=constants.SCAN_WORKERS):
+    files = []
+    def visit(path):
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(f'{path}/{entry.name}')
+                    else:
+                        files.append((path, entry.name))
+        except OSError:
+            # Gone, not a folder or no access, skipped as os.walk did
+            pass
+        return subdirs
+    scan_dirs([root.rstrip('/')], visit, max_workers)
+    return files
+
+def is_partial(name):
+    return name.endswith(f".{constants.PARTIAL_DOWNLOAD_EXT}")
+
+# Post id from a filename in cache/ or downloads/, or None
+def file_id(root, name):
+    # Files of md5 cache are named by content, not by post
+    if root == 'md5':
+        return None
+    if root == 'cache':
+        try:
+            return int(name.split('.')[-2]) #id section
+        except (IndexError, ValueError):
+            return None
+    match = IMAGE_MATCH.match(name)
+    if match:
+        return int(match[1])
+    return None
+
+FILE_INDEX_VERSION = 2
+
+class FileIndex:
+    # Persistent post id -> file paths index of cache/ and downloads/,
+    # kept in files.db between runs. refresh() lists again only folders
+    # whose mtime has changed, unchanged folders are taken from the index,
+    # so a run costs one stat per folder instead of a walk over every file.
+    # Both trees are scanned at once with scan_dirs.
+    # Works as a dict for get_files: `id in files`, `files[id] = path`.
+    # Download workers never write to sqlite: new paths are kept
+    # in memory until flush() is called from the main thread.
+    ROOTS = ('cache', 'downloads')
+
+    def __init__(self, filename='files.db'):
+        self._lock = Lock()
+        self._pending_lock = Lock()
+        self._pending = {}
+        self.conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        # Reads from workers don't wait for PathesStorage writes
+        # on the same file, and writers wait for each other
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(f'PRAGMA busy_timeout={constants.SQLITE_BUSY_MS}')
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < FILE_INDEX_VERSION:
+            # It is only an index, a full scan builds it again
+            self.conn.executescript(
+                '''
+                DROP TABLE IF EXISTS index_dirs;
+                DROP TABLE IF EXISTS index_files;'''
+            )
+            self.conn.execute(f'PRAGMA user_version = {FILE_INDEX_VERSION}')
+        self.conn.executescript(
+            '''
+            CREATE TABLE IF NOT EXISTS index_dirs (
+                path     TEXT PRIMARY KEY
+                              NOT NULL,
+                parent   TEXT,
+                mtime_ns INTEGER NOT NULL
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS index_files (
+                path    TEXT PRIMARY KEY
+                             NOT NULL,
+                dir     TEXT NOT NULL,
+                root    TEXT NOT NULL,
+                id      INTEGER NOT NULL,
+                partial INTEGER NOT NULL
+            ) WITHOUT ROWID;
+
+            CREATE INDEX IF NOT EXISTS index_files_dir ON index_files (dir);
+            CREATE INDEX IF NOT EXISTS index_files_id ON index_files (id);'''
+        )
+
+    def close(self):
+        self.conn.close()
+
+    # Paths are stored the way they were always compared with
+    # make_path results: lowercased folder and filename as is
+    @staticmethod
+    def _dir_key(path):
+        return path.replace('\\','/').lower()
+
+    def _list_dir(self, path, root):
+        rows = []
+        subdirs = []
+        key = self._dir_key(path)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(f'{path}/{entry.name}')
+                    continue
+                id = file_id(root, entry.name)
+                if id is not None:
+                    rows.append((f'{key}/{entry.name}', key, root, id, is_partial(entry.name)))
+        return rows, subdirs
+
+    def refresh(self, max_workers=constants.SCAN_WORKERS):
+        with self._lock:
+            cur = self.conn.cursor()
+            known = {}
+            children = {}
+            for path, parent, mtime_ns in cur.execute('SELECT path, parent, mtime_ns FROM index_dirs'):
+                known[path] = mtime_ns
+                children.setdefault(path, [])
+                if parent is not None:
+                    children.setdefault(parent, []).append(path)
+
+            # A folder can still change within the same mtime tick,
+            # so folders changed just now are listed again next time
+            recent = (time() - 2) * 1e9
+
+            # Filled from pool threads, list.append is atomic
+            seen = []
+            listed = []
+            def visit(item):
+                path, parent, root = item
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                    if known.get(path) == mtime_ns:
+                        subdirs = children.get(path, ())
+                    else:
+                        rows, subdirs = self._list_dir(path, root)
+                        listed.append((path, parent, mtime_ns if mtime_ns < recent else -1, rows))
+                except OSError:
+                    # Not seen, so files indexed there are dropped
+                    return []
+                seen.append(path)
+                return [(subdir, path, 'md5' if subdir == constants.MD5_CACHE_DIR else root)
+                        for subdir in subdirs]
+
+            scan_dirs([(root, None, root) for root in self.ROOTS], visit, max_workers)
+
+            cur.execute("BEGIN;")
+            for path, parent, mtime_ns, rows in listed:
+                cur.execute('DELETE FROM index_files WHERE dir=?;', (self._dir_key(path),))
+                cur.executemany('INSERT OR REPLACE INTO index_files VALUES (?,?,?,?,?);', rows)
+                cur.execute('INSERT OR REPLACE INTO index_dirs VALUES (?,?,?);', (path, parent, mtime_ns))
+
+            for path in known.keys() - set(seen):
+                cur.execute('DELETE FROM index_dirs WHERE path=?;', (path,))
+                cur.execute('DELETE FROM index_files WHERE dir=?;', (self._dir_key(path),))
+            cur.execute("COMMIT;")
+
+    def get(self, id, default=None):
+        with self._lock:
+            # The same as before: a cached file is preferred
+            row = self.conn.execute("SELECT path FROM index_files WHERE id=? AND NOT partial ORDER BY root='cache' DESC LIMIT 1",
+                                    (id,)).fetchone()
+        if row:
+            return row[0]
+        with self._pending_lock:
+            return self._pending.get(id, default)
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def __getitem__(self, id):
+        path = self.get(id)
+        if path is None:
+            raise KeyError(id)
+        return path
+
+    def __setitem__(self, id, path):
+        with self._pending_lock:
+            self._pending[id] = path.replace('\\','/')
+
+    # Writes paths set since the last flush in one transaction
+    def flush(self):
+        with self._pending_lock:
+            pending = dict(self._pending)
+        if not pending:
+            return
+
+        rows = []
+        for id, path in pending.items():
+            directory, dummy, dummy = path.rpartition('/')
+            rows.append((path, self._dir_key(directory), directory.split('/')[0], id, is_partial(path)))
+        with self._lock:
+            self.conn.execute("BEGIN;")
+            self.conn.executemany('INSERT OR REPLACE INTO index_files VALUES (?,?,?,?,?);', rows)
+            self.conn.execute("COMMIT;")
+
+        # Kept in memory until they can be read from the index
+        with self._pending_lock:
+            for id, path in pending.items():
+                if self._pending.get(id) == path:
+                    del self._pending[id]
+
+    def partial_downloads(self):
+        with self._lock:
+            return [path for (path, ) in self.conn.execute(
+                "SELECT path FROM index_files WHERE root='downloads' AND partial")]
+
+    # Folders of downloads/ with no posts in them, deepest first
+    def empty_dirs(self):
+        with self._lock:
+            dirs = [path for (path, ) in self.conn.execute('''
+                SELECT path FROM index_dirs
+                WHERE parent IS NOT NULL AND path LIKE 'downloads/%' AND NOT EXISTS (
+                    SELECT 1 FROM index_files WHERE index_files.dir = lower(index_dirs.path))''')]
+        return sorted(dirs, key=len, reverse=True)
+
+    def discard(self, paths):
+        with self._lock:
+            self.conn.execute("BEGIN;")
+            self.conn.executemany('DELETE FROM index_files WHERE path=?;', ((path,) for path in paths))
+            self.conn.execute("COMMIT;")
+
+def get_files_dict(reset_filedb):
+    files = FileIndex()
+    files.refresh()
 
     if reset_filedb:
-        cur.executescript(
+        files.conn.executescript(
             '''
             BEGIN TRANSACTION;
             DROP TABLE IF EXISTS old_files;
@@ -600,89 +1317,27 @@ def get_files_dict(reset_filedb):
                                UNIQUE
                                NOT NULL
             ) WITHOUT ROWID;
+
+            INSERT INTO old_files SELECT path FROM index_files WHERE root='downloads';
             
             COMMIT;
             '''
         )
     
-    conn.commit()
-    cur.execute("BEGIN TRANSACTION;")
-    for root, dirs, files in os.walk('downloads/'):
-        for file in files:
-            match = IMAGE_MATCH.match(file)
-            if match:
-                id=int(match[1])
-                filepath='{}/{}'.format(root.replace('\\','/').lower(),file)
-                if id not in filedict:
-                    filedict[id]=filepath
-                if reset_filedb:
-                    cur.execute('INSERT INTO old_files VALUES (?);', (filepath,))
-    cur.execute("COMMIT;")
-    conn.commit()
-    
-    return filedict
-
-def prune_cache():
-    conn = sqlite3.connect('files.db', isolation_level=None)
-    cur = conn.cursor()
-    cur.executescript(
-        '''
-        BEGIN TRANSACTION;
-        DROP TABLE IF EXISTS used_ids;
-        
-        CREATE TABLE used_ids (
-            id    INTEGER PRIMARY KEY
-                           UNIQUE
-                           NOT NULL
-        ) WITHOUT ROWID;
+    return files
 
-        DROP TABLE IF EXISTS cached_files;
-        
-        CREATE TABLE cached_files (
-            id    INTEGER PRIMARY KEY
-                           UNIQUE
-                           NOT NULL,
-            fullpath       TEXT 
-                           UNIQUE
-                           NOT NULL   
-        ) WITHOUT ROWID;
-        
-        COMMIT;
-        '''
-    )
-    
-    conn.commit()
-    cur.execute("BEGIN TRANSACTION;")
-    for root, dirs, files in os.walk('downloads/'):
-        for file in files:
-            match = IMAGE_MATCH.match(file)
-            if match:
-                id=int(match[1])
-                cur.execute('INSERT OR IGNORE INTO used_ids VALUES (?);', (id,))
-    cur.execute("COMMIT;")
-    conn.commit()
-    
-    cur.execute("BEGIN TRANSACTION;")
-    for root, dirs, files in os.walk('cache/'):
-        for file in files:
-            try:
-                id=file.split('.')[-2] #id section
-                id=int(id)
-                filepath='{}/{}'.format(root.replace('\\','/').lower(),file)
-                cur.execute('INSERT INTO cached_files VALUES (?,?);', (id,filepath))
-            except (IndexError, ValueError):
-                pass
-    cur.execute("COMMIT;")
-    conn.commit()
-    
-    cur.execute('''
-        SELECT fullpath FROM cached_files
-        LEFT JOIN used_ids
-        ON used_ids.id = cached_files.id
-        WHERE used_ids.id IS NULL;''')
-    for (filename, ) in cur:
+def prune_cache(files):
+    # Cached copies made during this run are not in the index yet
+    files.refresh()
+    with files._lock:
+        unused = [path for (path, ) in files.conn.execute('''
+            SELECT path FROM index_files
+            WHERE root='cache' AND id NOT IN (
+                SELECT id FROM index_files WHERE root='downloads');''')]
+    for filename in unused:
         with suppress(FileNotFoundError):
             os.remove(filename)
+    files.discard(unused)
     
 def validate_format(format):
     post = {i:i for i in constants.DEFAULT_SLOTS}
@@ -705,27 +1360,29 @@ def get_blocked_posts():
         for line in f:
             blocked_ids.add(int(line))
     
-    for root, dirs, files in os.walk('to_blocked_posts/'):
-        for file in files:
-            match = IMAGE_MATCH.match(file)
-            if match:
-                id=int(match[1])
-                blocked_ids.add(id)
+    to_block = list_files('to_blocked_posts')
+    for root, file in to_block:
+        match = IMAGE_MATCH.match(file)
+        if match:
+            id=int(match[1])
+            blocked_ids.add(id)
     
     with open("blocked_posts_new.txt" , "w") as f:
         for id in sorted(blocked_ids):
             print(id, file=f)
             
     os.replace("blocked_posts_new.txt", "blocked_posts.txt")
-    for root, dirs, files in os.walk('to_blocked_posts/'):
-        for file in files:
-            filepath='{}/{}'.format(root,file)
-            os.remove(filepath)
+    for root, file in to_block:
+        filepath='{}/{}'.format(root,file)
+        os.remove(filepath)
             
     return blocked_ids
 
-def remove_empty_folders():
-    for root, dirs, files in os.walk('downloads/', topdown=False):
+def remove_empty_folders(files):
+    # Only folders without posts in the index are tried,
+    # the rest can't be empty
+    files.refresh()
+    for root in files.empty_dirs():
         try:
             os.rmdir(root)
         except (OSError, FileNotFoundError):
@@ -0,0 +1,193 @@
+# Internal Imports
+import json
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Event, Lock, Thread, local
+from time import perf_counter, time
+
+METRICS_FORMATS = {'json', 'prometheus'}
+
+# Seconds, for API requests and downloads
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class _Sharded:
+    # Every thread gets its own cell and is the only one writing to it,
+    # so an increment is a thread-local lookup and an addition, no lock.
+    # Readers sum all cells, cells of finished threads are kept.
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._local = local()
+        self._cells = []
+        self._lock = Lock()
+
+    def _new_cell(self):
+        cell = self._local.cell = self._empty_cell()
+        with self._lock:
+            self._cells.append(cell)
+        return cell
+
+    def _cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            return self._new_cell()
+
+class Counter(_Sharded):
+    kind = 'counter'
+
+    def _empty_cell(self):
+        return [0]
+
+    def inc(self, amount=1):
+        self._cell()[0] += amount
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells))
+
+class Gauge:
+    # Set from one place at a time, a plain attribute is enough
+    kind = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+class Histogram(_Sharded):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    # [sum, count, per bucket..., above the last bucket]
+    def _empty_cell(self):
+        return [0.0, 0] + [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        cell = self._cell()
+        cell[0] += value
+        cell[1] += 1
+        cell[2 + bisect_left(self.buckets, value)] += 1
+
+    @contextmanager
+    def time(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    @property
+    def value(self):
+        totals = [0.0, 0] + [0] * (len(self.buckets) + 1)
+        for cell in list(self._cells):
+            for i, v in enumerate(cell):
+                totals[i] += v
+
+        cumulative = {}
+        count = 0
+        for bound, bucket in zip(self.buckets + (float('inf'),), totals[2:]):
+            count += bucket
+            cumulative['+Inf' if bound == float('inf') else repr(bound)] = count
+        return {'sum': totals[0], 'count': totals[1], 'buckets': cumulative}
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _add(self, cls, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            return self._metrics[name]
+
+    def counter(self, name, help=''):
+        return self._add(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._add(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram, name, help, buckets)
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.value for metric in metrics}
+
+    def to_json(self):
+        return json.dumps({'time': time(), **self.snapshot()})
+
+    def to_prometheus(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            value = metric.value
+            if metric.kind == 'histogram':
+                for bound, count in value['buckets'].items():
+                    lines.append(f'{metric.name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f'{metric.name}_sum {value["sum"]}')
+                lines.append(f'{metric.name}_count {value["count"]}')
+            else:
+                lines.append(f'{metric.name} {value}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+class Exporter(Thread):
+    # Writes all metrics every interval seconds: json appends a line
+    # to the file, prometheus replaces the file (node_exporter textfile style)
+    def __init__(self, filename, format, interval):
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.format = format
+        self.interval = interval
+        self._stop_event = Event()
+
+    def write(self):
+        if self.format == 'json':
+            with open(self.filename, 'a') as outfile:
+                print(registry.to_json(), file=outfile)
+        else:
+            temp_filename = f'{self.filename}.tmp'
+            with open(temp_filename, 'w') as outfile:
+                outfile.write(registry.to_prometheus())
+            os.replace(temp_filename, self.filename)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.write()
+
+_exporter = None
+
+def start_export(filename, format='json', interval=10.0):
+    global _exporter
+    if _exporter is not None:
+        if (_exporter.filename, _exporter.format, _exporter.interval) == (filename, format, interval):
+            return
+        stop_export()
+    _exporter = Exporter(filename, format, interval)
+    _exporter.start()
+
+def stop_export():
+    global _exporter
+    if _exporter is not None:
+        _exporter.stop()
+        _exporter = None
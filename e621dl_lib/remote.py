@@ -1,27 +1,48 @@
 # Internal Imports
+import asyncio
 import os
-from time import sleep, time
+from time import sleep, monotonic, time
+from threading import Lock, Thread, Event
+from queue import Queue, Full
 from datetime import datetime
-from functools import lru_cache
 import sqlite3
 import pickle
 import re
 from html import unescape
 from urllib.parse import urlparse
 import json
+import codecs
+import hashlib
 
 # Personal Imports
 from . import constants
-from .local import printer
+from . import metrics
+from . import tracing
+from .local import printer, TagAliasCache
 
 # Vendor Imports
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from requests.exceptions import ConnectionError, ReadTimeout
+from requests.exceptions import ChunkedEncodingError, ConnectionError, ReadTimeout
+
+# Optional Imports
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 TIMEOUT = constants.CONNECTION_TIMEOUT
 
+# All API requests go here, benchmarks point it to a local stand-in
+BASE_URL = 'https://e621.net'
+
+tag_cache = TagAliasCache()
+
+api_requests = metrics.registry.counter('e621dl_api_requests_total', 'Requests to e621 API')
+api_seconds = metrics.registry.histogram('e621dl_api_request_seconds', 'Time to API response headers')
+download_seconds = metrics.registry.histogram('e621dl_download_seconds', 'Time to download one file')
+
 class Post:
     __slots__ = constants.DEFAULT_SLOTS
     def __init__(self, post, metatags):
@@ -71,12 +92,145 @@ class Post:
     def generate(self):
         return {name:getattr(self,name,'Unknown') for name in self.__slots__}
 
-def make_posts_list(json_list, metatags):
-    post_list=[]
-    for post in json_list:
-        if post["file"]["url"]:
-            post_list.append(Post(post, metatags))
-    return post_list
+def _raw_field(*keys):
+    def get(self):
+        value = self._post
+        for key in keys:
+            value = value[key]
+        return value
+    return property(get)
+
+def _cached_field(func):
+    name = func.__name__
+    def get(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = func(self)
+            return value
+    def set(self, value):
+        self._cache[name] = value
+    return property(get, set)
+
+class LazyPost:
+    # The same fields as Post, but it keeps api json as is
+    # and computes fields only when they are first needed.
+    # Most posts are rejected after a look at id and tags,
+    # so dates are never parsed for them.
+    __slots__ = ('_post', '_metatags', '_cache')
+    def __init__(self, post, metatags):
+        self._post = post
+        self._metatags = metatags
+        self._cache = {}
+
+    # Computed fields are not stored, they are cheap to get again
+    def __getstate__(self):
+        return self._post, self._metatags
+
+    def __setstate__(self, state):
+        self._post, self._metatags = state
+        self._cache = {}
+
+    id = _raw_field('id')
+    created_at_string = _raw_field('created_at')
+    tag_ex = _raw_field('tags')
+    rating = _raw_field('rating')
+    md5 = _raw_field('file', 'md5')
+    file_ext = _raw_field('file', 'ext')
+    file_url = _raw_field('file', 'url')
+    file_size = _raw_field('file', 'size')
+    width = _raw_field('file', 'width')
+    height = _raw_field('file', 'height')
+    score = _raw_field('score', 'total')
+    score_up = _raw_field('score', 'up')
+    score_down = _raw_field('score', 'down')
+    fav_count = _raw_field('fav_count')
+    sources = _raw_field('sources')
+    description = _raw_field('description')
+    pools = _raw_field('pools')
+    creator_id = _raw_field('uploader_id')
+
+    @_cached_field
+    def tags(self):
+        tags = []
+        for dummy_cat, taglist in self.tag_ex.items():
+            tags += taglist
+        return tags + self._metatags
+
+    @_cached_field
+    def artist(self):
+        return '_'.join(self.tag_ex["artist"])
+
+    @_cached_field
+    def created_at(self):
+        created_at_datetime = datetime.fromisoformat(self.created_at_string)
+        created_at_timestamp = created_at_datetime.timestamp()
+        created_at_timestamp_s = int(created_at_timestamp)
+        return {'s': created_at_timestamp_s,
+                'n': (created_at_timestamp - created_at_timestamp_s) * 1000_000_000,
+                'tz': created_at_datetime.tzname(),
+                }
+
+    @_cached_field
+    def days_ago(self):
+        created_at = self.created_at
+        created_at_timestamp = created_at['s'] + created_at['n'] / 1000_000_000
+        return int(time() - created_at_timestamp)/86400
+
+    def generate(self):
+        return {name:getattr(self,name,'Unknown') for name in constants.DEFAULT_SLOTS}
+
+# Yields items of a top level json array, e.g. "posts" of posts.json,
+# as soon as each one is received, without waiting for the whole response.
+def iter_json_array(chunks, key):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = 0
+
+    def read_more():
+        nonlocal buffer, pos
+        for chunk in chunks:
+            if chunk:
+                buffer = buffer[pos:] + text_decoder.decode(chunk)
+                pos = 0
+                return True
+        return False
+
+    marker = f'"{key}"'
+    while marker not in buffer:
+        if not read_more():
+            raise ValueError(f'no "{key}" in response')
+    pos = buffer.index(marker) + len(marker)
+
+    # Skipping ':' and '[' before the first item
+    # and whitespaces and commas between items
+    expected = ':['
+    while True:
+        while pos >= len(buffer):
+            if not read_more():
+                raise ValueError('response ended too soon')
+        char = buffer[pos]
+        if char.isspace():
+            pos += 1
+        elif expected:
+            if char != expected[0]:
+                raise ValueError(f'unexpected {char!r} in response')
+            expected = expected[1:]
+            pos += 1
+        elif char == ',':
+            pos += 1
+        elif char == ']':
+            return
+        else:
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if not read_more():
+                    raise
+                continue
+            yield item
 
 def requests_retry_session(
     retries = 5,
@@ -85,14 +239,26 @@ def requests_retry_session(
     session = None,
 ):
     session = session or requests.Session()
-    retry = Retry(
-        total = retries,
-        read = retries,
-        connect = retries,
-        backoff_factor = backoff_factor,
-        status_forcelist = status_forcelist,
-        method_whitelist = frozenset(['GET', 'POST'])
-    )
+    # urllib3 1.26 renamed method_whitelist to allowed_methods, 2.0 removed the old name
+    methods = frozenset(['GET', 'POST'])
+    try:
+        retry = Retry(
+            total = retries,
+            read = retries,
+            connect = retries,
+            backoff_factor = backoff_factor,
+            status_forcelist = status_forcelist,
+            allowed_methods = methods
+        )
+    except TypeError:
+        retry = Retry(
+            total = retries,
+            read = retries,
+            connect = retries,
+            backoff_factor = backoff_factor,
+            status_forcelist = status_forcelist,
+            method_whitelist = methods
+        )
     adapter = HTTPAdapter(max_retries = retry)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
@@ -197,20 +363,60 @@ def solve_captcha(session, response):
     
     return not check_cloudflare(response) #means we solve a captcha
 
-def delayed_post(url, payload, session):
-    # Take time before and after getting the requests response.
-    start = time()
-    if payload:
-        response = retrying_post(session, url, data = payload, timeout=TIMEOUT)
-    else:
-        response = retrying_post(session, url, timeout=TIMEOUT)
-    elapsed = time() - start
-
+class RateLimiter:
+    # Token bucket shared by every e621 API request in the process.
     # Citation from e621:api
     # "You should make a best effort not to make 
     # more than one request per second over a sustained period."
-    if elapsed < 1.0:
-        sleep(1.0 - elapsed)
+    # Up to `burst` requests can go at once, then `rate` requests per second.
+    # A caller reserves its slot and sleeps outside of the lock,
+    # so the time spent on parsing and filtering since the last
+    # request counts toward the wait.
+    def __init__(self, rate = constants.API_RATE, burst = constants.API_BURST):
+        self._lock = Lock()
+        self.rate = max(rate, constants.MIN_API_RATE)
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = monotonic()
+
+    # Tokens are kept, debt of reserved requests included,
+    # so a new config does not get a free burst
+    def configure(self, rate, burst):
+        rate = max(rate, constants.MIN_API_RATE)
+        burst = max(burst, 1)
+        with self._lock:
+            if (rate, burst) == (self.rate, self.burst):
+                return
+            self._refill()
+            self.rate = rate
+            self.burst = burst
+            self._tokens = min(self._tokens, self.burst)
+
+    # Tokens gained since the last update, at the current rate
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+
+        if wait > 0:
+            sleep(wait)
+
+api_limiter = RateLimiter()
+
+def delayed_post(url, payload, session):
+    api_limiter.acquire()
+    api_requests.inc()
+    with api_seconds.time(), tracing.span('api request', 'api', url=urlparse(url).path):
+        if payload:
+            response = retrying_post(session, url, data = payload, timeout=TIMEOUT)
+        else:
+            response = retrying_post(session, url, timeout=TIMEOUT)
 
     if check_cloudflare(response):
         solve_captcha(session, response)
@@ -219,24 +425,18 @@ def delayed_post(url, payload, session):
     return response
 
 
-def delayed_get(url, payload, session):
-    # Take time before and after getting the requests response.
-    start = time()
-    if payload:
-        response = retrying_get(session, url, data = payload, timeout=TIMEOUT)
-    else:
-        response = retrying_get(session, url, timeout=TIMEOUT)
-    elapsed = time() - start
-
-    # Citation from e621:api
-    # "You should make a best effort not to make 
-    # more than one request per second over a sustained period."
-    if elapsed < 1.0:
-        sleep(1.0 - elapsed)
+def delayed_get(url, payload, session, **kwargs):
+    api_limiter.acquire()
+    api_requests.inc()
+    with api_seconds.time(), tracing.span('api request', 'api', url=urlparse(url).path):
+        if payload:
+            response = retrying_get(session, url, data = payload, timeout=TIMEOUT, **kwargs)
+        else:
+            response = retrying_get(session, url, timeout=TIMEOUT, **kwargs)
 
     if check_cloudflare(response):
         solve_captcha(session, response)
-        return delayed_get(url, payload, session)
+        return delayed_get(url, payload, session, **kwargs)
     
     return response
 
@@ -248,11 +448,13 @@ def get_github_release(session):
 
     return response.json()['tag_name'].strip('v')
 
-def get_posts(last_id, search_tags, earliest_date, session, api_key, login, **dummy):
+# raw_filter(post_json, metatags) can reject posts before Post is built
+def get_posts(last_id, search_tags, earliest_date, session, api_key, login, post_class=Post,
+              stream_posts=False, raw_filter=None, **dummy):
  
     metatags =[tag for tag in search_tags if ':' in tag and tag[0] not in '~-' and '*' not in tag]
     search_string = ' '.join(search_tags)
-    url = 'https://e621.net/posts.json'
+    url = f'{BASE_URL}/posts.json'
     
     reordered = False
     
@@ -278,43 +480,111 @@ def get_posts(last_id, search_tags, earliest_date, session, api_key, login, **du
         payload["login"] = login
         payload["api_key"] = api_key
 
-    while True:
-        start = time()
-        response = retrying_get(session, url, data=payload, timeout=TIMEOUT)
-        
-        
-        while check_cloudflare(response):
-            solve_captcha(session, response)
-            elapsed = time() - start
-            if elapsed < 1.0:
-                sleep(1.0 - elapsed)
-            response = retrying_get(session, url, data=payload, timeout=TIMEOUT)
-        
-        response.raise_for_status()
+    def read_page(response):
+        if stream_posts:
+            posts_orig = iter_json_array(response.iter_content(chunk_size=65536), "posts")
+        else:
+            posts_orig = response.json()["posts"]
+
+        results = []
+        posts_count = 0
+        rejected = 0
+        page_last_id = last_id
+        for post in posts_orig:
+            posts_count += 1
+            page_last_id = post["id"]
+            if not post["file"]["url"]:
+                continue
+            if raw_filter and not raw_filter(post, metatags):
+                rejected += 1
+                continue
+            results.append(post_class(post, metatags))
+        return results, posts_count, rejected, page_last_id
 
-        posts_orig = response.json()["posts"]
-        results=make_posts_list(posts_orig, metatags)
-        
+    while True:
+        # A streamed body is read outside of retrying_get, so a broken one
+        # is requested again from the same cursor. A page is yielded
+        # only when it is read whole, no post is yielded twice.
+        for i in range(1,100):
+            response = delayed_get(url, payload, session, stream=stream_posts)
+            with response:
+                response.raise_for_status()
+                try:
+                    results, posts_count, rejected, last_id = read_page(response)
+                    break
+                except (ChunkedEncodingError, ConnectionError, ReadTimeout):
+                    printer.increment_retries()
+        else:
+            response = delayed_get(url, payload, session, stream=stream_posts)
+            with response:
+                response.raise_for_status()
+                results, posts_count, rejected, last_id = read_page(response)
+
+        if rejected:
+            printer.increment_posts(rejected)
+            printer.increment_filtered(rejected)
  
         if results:
             yield results
         
-        if len(posts_orig) < constants.MAX_RESULTS:
+        if posts_count < constants.MAX_RESULTS:
             break
         elif reordered:
             payload['page'] += 1
             if payload['page'] > 750:
                 break
         else:
-            last_id = results[-1].id
             payload["tags"] = f"id:<{last_id} {tags}"
-        
-        elapsed = time() - start
-        if elapsed < 1.0:
-            sleep(1.0 - elapsed)
+
+# Wraps a posts generator function, so up to `depth` pages are requested
+# ahead of the consumer in a background thread. The wrapped generator still
+# moves its own id:<last_id cursor and goes through api_limiter,
+# so the request rate is the same. Only the waiting for the
+# next page overlaps with filtering and downloading of the current one.
+def prefetching(gen_func, depth):
+    def gen(*args, **kwargs):
+        pages = Queue(maxsize=depth)
+        stop = Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def fetch():
+            inner = gen_func(*args, **kwargs)
+            try:
+                for page in inner:
+                    if not put((page, None)):
+                        return
+                put((None, None))
+            except BaseException as e:
+                put((None, e))
+            finally:
+                inner.close()
+
+        Thread(target=fetch, daemon=True).start()
+        try:
+            while True:
+                page, error = pages.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    return
+                yield page
+        finally:
+            # Consumer may stop early, e.g. on days limit,
+            # at most `depth` pages are fetched in vain
+            stop.set()
+
+    return gen
 
 def get_known_post(post_id, api_key, login, session):
-    url = f'https://e621.net/posts/{post_id}.json'
+    url = f'{BASE_URL}/posts/{post_id}.json'
 
     if api_key and login:
         response = delayed_get(url, {'login':login, 'api_key': api_key}, session)
@@ -324,7 +594,57 @@ def get_known_post(post_id, api_key, login, session):
 
     return response.json()["post"]
 
-@lru_cache(maxsize=512, typed=False)
+# tags.json returns {"tags": []} instead of an empty list
+def json_list(results, key):
+    if isinstance(results, dict):
+        return results.get(key, [])
+    return results
+
+# Checks a lot of tags with as few requests as possible
+# and puts everything found to tag_cache, so get_tag_alias
+# doesn't have to ask e621 about them one by one.
+# Tags that are not found here, as well as masks with '*',
+# are left for get_tag_alias to check and report.
+def prefetch_tag_aliases(user_tags, api_key, login, session):
+    names = {tag.lstrip('-~') for tag in user_tags}
+    names = sorted(name for name in names
+                   if name and ':' not in name and '*' not in name and tag_cache.get(name) is None)
+    if not names:
+        return
+
+    auth = {'login':login, 'api_key': api_key} if api_key and login else {}
+    found = {}
+
+    def batches(tags):
+        for i in range(0, len(tags), constants.TAG_BATCH_SIZE):
+            yield tags[i:i+constants.TAG_BATCH_SIZE]
+
+    for batch in batches(names):
+        printer.change_tag(f"checking {len(batch)} tags starting with {batch[0]}")
+        payload = {'search[name]': ','.join(batch), 'limit': constants.MAX_RESULTS, **auth}
+        response = delayed_get(f'{BASE_URL}/tags.json', payload, session)
+        response.raise_for_status()
+
+        batch = set(batch)
+        for tag in json_list(response.json(), 'tags'):
+            if tag['name'] in batch:
+                found[tag['name']] = tag['name']
+
+    for batch in batches([name for name in names if name not in found]):
+        printer.change_tag(f"checking aliases of {len(batch)} tags starting with {batch[0]}")
+        payload = {'search[antecedent_name]': ' '.join(batch), 'search[status]': 'Approved',
+                   'limit': constants.MAX_RESULTS, **auth}
+        response = delayed_get(f'{BASE_URL}/tag_aliases.json', payload, session)
+        response.raise_for_status()
+
+        batch = set(batch)
+        for alias in json_list(response.json(), 'tag_aliases'):
+            if alias['antecedent_name'] in batch and alias['antecedent_name'] not in found:
+                found[alias['antecedent_name']] = alias['consequent_name']
+
+    tag_cache.put_many(found.items())
+    printer.change_tag(f"{len(found)} of {len(names)} tags checked at once")
+
 def get_tag_alias(user_tag, api_key, login, session):
     prefix = ''
     
@@ -342,7 +662,37 @@ def get_tag_alias(user_tag, api_key, login, session):
         printer.change_warning(f"Impossible to check if {user_tag} is valid.")
         return user_tag    
 
-    url = 'https://e621.net/tags.json'
+    actual_tag = tag_cache.get(user_tag)
+    if actual_tag is None:
+        with tracing.span('resolve tag', 'tags', tag=user_tag):
+            actual_tag = lookup_tag_alias(user_tag, api_key, login, session)
+        tag_cache.put(user_tag, actual_tag)
+    elif actual_tag != user_tag:
+        printer.change_tag(f"{user_tag} was changed to {actual_tag}.")
+    else:
+        printer.change_tag(f"{user_tag} is valid.")
+
+    return actual_tag
+
+# get_tag_alias for offline mode: only what is known locally,
+# from tag cache or imported tags, everything else is left as is
+def get_local_tag_alias(user_tag, api_key, login, session):
+    if user_tag[0] in '~-':
+        return user_tag[0] + get_local_tag_alias(user_tag[1:], api_key, login, session)
+
+    if ':' in user_tag:
+        return user_tag
+
+    actual_tag = tag_cache.get(user_tag)
+    if actual_tag is None:
+        printer.change_warning(f"{user_tag} is not known locally and can't be checked offline.")
+        return user_tag
+    return actual_tag
+
+def lookup_tag_alias(user_tag, api_key, login, session):
+    prefix = ''
+
+    url = f'{BASE_URL}/tags.json'
     if api_key and login:
         payload = {'search[name_matches]': user_tag, 'login':login, 'api_key': api_key}
     else:
@@ -376,7 +726,7 @@ def get_tag_alias(user_tag, api_key, login, session):
     
     pagenum = 1
     def alias_chunk():
-        url = 'https://e621.net/tag_aliases.json'
+        url = f'{BASE_URL}/tag_aliases.json'
         if api_key and login:
             payload = {'search[status]': 'Approved', 'search[name_matches]': user_tag, 'page': pagenum, 'login':login, 'api_key': api_key}
         else:
@@ -410,7 +760,59 @@ def get_tag_alias(user_tag, api_key, login, session):
     raise SystemExit
     return ''
 
-def download_post(url, path, session, cachefunc, duplicate_func, api_key, login):
+class ChecksumMismatch(Exception):
+    pass
+
+def md5_cache_path(md5, ext):
+    return f"{constants.MD5_CACHE_DIR}/{md5}.{ext}"
+
+# md5 of what is already downloaded, so a resumed download
+# is hashed as a whole without reading it once more afterwards
+def partial_hash(path):
+    hasher = hashlib.md5()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher
+
+# Creates file if it does not exist so that os.path.getsize does not raise an exception.
+def create_partial(path):
+    try:
+        open(path, 'x').close()
+    except FileExistsError:
+        pass
+
+# Starting over, resuming a broken file makes no sense
+def truncate_partial(path):
+    open(path, 'w').close()
+
+# Written data goes into the hasher too, so it always matches what is on disk
+def write_chunk(outfile, hasher, data):
+    outfile.write(data)
+    if hasher:
+        hasher.update(data)
+
+# Renames finished partial download and puts it into the cache
+def finish_download(path, cachefunc, duplicate_func, md5_path=None):
+    newpath=path.replace(f".{constants.PARTIAL_DOWNLOAD_EXT}", '')
+    os.rename(path, newpath)
+    printer.change_file(newpath)
+    printer.increment_bytes(os.path.getsize(newpath))
+    if cachefunc:
+        basename=os.path.basename(newpath)
+        cachepath='.'.join(basename.split('.')[-2:])
+        try:
+            duplicate_func(newpath, f"cache/{cachepath}")
+        except FileExistsError:
+            os.remove(newpath)
+            duplicate_func(f"cache/{cachepath}", newpath)
+    if md5_path:
+        try:
+            duplicate_func(newpath, md5_path)
+        except FileExistsError:
+            pass
+
+def download_post(url, path, session, cachefunc, duplicate_func, api_key, login, md5=None, md5_cache=False):
     if f".{constants.PARTIAL_DOWNLOAD_EXT}" not in path:
         path += f".{constants.PARTIAL_DOWNLOAD_EXT}"
 
@@ -420,7 +822,13 @@ def download_post(url, path, session, cachefunc, duplicate_func, api_key, login)
     except FileExistsError:
         pass
 
+    # Files are checked against md5 only with md5_cache on
+    if not md5_cache:
+        md5 = None
+    md5_path = md5_cache_path(md5, url.split('.')[-1]) if md5 else None
+
     def stream_download():
+        hasher = partial_hash(path) if md5 else None
         header = {'Range': f"bytes={os.path.getsize(path)}-"}
         if api_key and login:
             response = retrying_get(session, url, stream = True, headers = header, data={'login':login, 'api_key': api_key}, timeout=TIMEOUT)
@@ -431,41 +839,126 @@ def download_post(url, path, session, cachefunc, duplicate_func, api_key, login)
             with open(path, 'ab') as outfile:
                 for chunk in response.iter_content(chunk_size = 8192):
                     outfile.write(chunk)
-            newpath=path.replace(f".{constants.PARTIAL_DOWNLOAD_EXT}", '')
-            os.rename(path, newpath)
-            printer.change_file(newpath)
-            if cachefunc:
-                basename=os.path.basename(newpath)
-                cachepath='.'.join(basename.split('.')[-2:])
-                try:
-                    duplicate_func(newpath, f"cache/{cachepath}")
-                except FileExistsError:
-                    os.remove(newpath)
-                    duplicate_func(f"cache/{cachepath}", newpath)
-                    
-                    
+                    if hasher:
+                        hasher.update(chunk)
+            if hasher and hasher.hexdigest() != md5:
+                # Starting over, resuming a broken file makes no sense
+                open(path, 'w').close()
+                raise ChecksumMismatch(path)
+            finish_download(path, cachefunc, duplicate_func, md5_path)
             return True
 
         else:
             os.remove(path)
             return False
 
-    for i in range(1,100):
+    def retrying_download():
+        for i in range(1,100):
+            try:
+                return stream_download()
+            except (ConnectionError, ReadTimeout):
+                printer.increment_retries()
+                
+        return stream_download()
+
+    # A corrupt transfer is tried once more from scratch
+    with download_seconds.time():
         try:
-            return stream_download()
-        except (ConnectionError, ReadTimeout):
+            return retrying_download()
+        except ChecksumMismatch:
             printer.increment_retries()
-            
-    return stream_download()
-    
+        try:
+            return retrying_download()
+        except ChecksumMismatch:
+            os.remove(path)
+            printer.change_warning(f"{os.path.basename(path)} does not match its md5, skipped")
+            return False
     
-def finish_partial_downloads(session, cachefunc, duplicate_func, api_key, login):
-    for root, dirs, files in os.walk('downloads/'):
-        for file in files:
-            if file.endswith(constants.PARTIAL_DOWNLOAD_EXT):
-                printer.change_warning(f" Partial download {file} found.")
+async def download_post_async(url, path, client, cachefunc, duplicate_func, api_key, login, md5=None, md5_cache=False):
+    # Same as download_post, but for aiohttp client session.
+    # Resume semantics are the same, so partial downloads from
+    # one engine are finished by the other just fine.
+    if f".{constants.PARTIAL_DOWNLOAD_EXT}" not in path:
+        path += f".{constants.PARTIAL_DOWNLOAD_EXT}"
+
+    loop = asyncio.get_running_loop()
+    # Disk work is done in the executor, a slow disk should not stall other downloads
+    await loop.run_in_executor(None, create_partial, path)
+
+    # Files are checked against md5 only with md5_cache on
+    if not md5_cache:
+        md5 = None
+    md5_path = md5_cache_path(md5, url.split('.')[-1]) if md5 else None
 
-                path = os.path.join(root, file)
-                url = get_known_post(file.split('.')[-3], api_key, login, session)['file']['url']
+    async def stream_download():
+        hasher = await loop.run_in_executor(None, partial_hash, path) if md5 else None
+        size = await loop.run_in_executor(None, os.path.getsize, path)
+        header = {'Range': f"bytes={size}-"}
+        if api_key and login:
+            request = client.get(url, headers = header, data={'login':login, 'api_key': api_key})
+        else:
+            request = client.get(url, headers = header)
+
+        async with request as response:
+            if response.ok:
+                outfile = await loop.run_in_executor(None, open, path, 'ab')
+                try:
+                    # Chunks are collected and written out together, not one executor call per 64 KiB
+                    buffer = bytearray()
+                    async for chunk in response.content.iter_chunked(65536):
+                        buffer += chunk
+                        if len(buffer) >= constants.ASYNC_WRITE_BUFFER:
+                            await loop.run_in_executor(None, write_chunk, outfile, hasher, bytes(buffer))
+                            buffer.clear()
+                    if buffer:
+                        await loop.run_in_executor(None, write_chunk, outfile, hasher, bytes(buffer))
+                finally:
+                    await loop.run_in_executor(None, outfile.close)
+            else:
+                await loop.run_in_executor(None, os.remove, path)
+                return False
+
+        if hasher and hasher.hexdigest() != md5:
+            await loop.run_in_executor(None, truncate_partial, path)
+            raise ChecksumMismatch(path)
+
+        # Copying to cache can take a while for big files
+        await loop.run_in_executor(None, finish_download, path, cachefunc, duplicate_func, md5_path)
+        return True
+
+    async def retrying_download():
+        for i in range(1,100):
+            try:
+                return await stream_download()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                printer.increment_retries()
+
+        return await stream_download()
+
+    with download_seconds.time():
+        try:
+            return await retrying_download()
+        except ChecksumMismatch:
+            printer.increment_retries()
+        try:
+            return await retrying_download()
+        except ChecksumMismatch:
+            await loop.run_in_executor(None, os.remove, path)
+            printer.change_warning(f"{os.path.basename(path)} does not match its md5, skipped")
+            return False
 
-                download_post(url, path, session, cachefunc, duplicate_func, api_key, login)
+def finish_partial_downloads(session, cachefunc, duplicate_func, api_key, login, files, md5_cache=False):
+    # Partial downloads are found in the file index, no need to walk downloads/
+    for path in files.partial_downloads():
+        if not os.path.isfile(path):
+            continue
+        file = os.path.basename(path)
+        printer.change_warning(f" Partial download {file} found.")
+
+        post_file = get_known_post(file.split('.')[-3], api_key, login, session)['file']
+
+        if download_post(post_file['url'], path, session, cachefunc, duplicate_func, api_key, login,
+                         md5=post_file['md5'], md5_cache=md5_cache):
+            files[int(file.split('.')[-3])] = path.replace(f".{constants.PARTIAL_DOWNLOAD_EXT}", '')
+        files.discard([path])
+    files.flush()
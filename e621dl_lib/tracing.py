@@ -0,0 +1,131 @@
+# Opt-in tracing of a run in Chrome trace event format.
+# Trace file opens in https://ui.perfetto.dev or chrome://tracing.
+#
+# Usage:
+#     with tracing.span('api page', tags=tags):
+#         ...
+# or, when a block is too long for `with`:
+#     parse_span = tracing.span('parse config')
+#     ...
+#     parse_span.end()
+#
+# When tracing is off, span() returns one shared object that does nothing.
+
+# Internal Imports
+import asyncio
+import json
+import os
+from threading import current_thread, get_ident, Lock
+from time import perf_counter_ns
+
+_events = []
+_thread_names = {}
+_lock = Lock()
+_filename = None
+_start_ns = 0
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def end(self):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ('name', 'cat', 'args', 'start_ns', 'tid')
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.tid = get_ident()
+        if self.tid not in _thread_names:
+            _thread_names[self.tid] = current_thread().name
+        self.start_ns = perf_counter_ns()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.end()
+        return False
+
+    # Coroutines of one loop overlap in one thread,
+    # so each task gets a track of its own
+    async def __aenter__(self):
+        task = asyncio.current_task()
+        if task is not None:
+            self.tid = id(task)
+            _thread_names.setdefault(self.tid, task.get_name())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.end()
+        return False
+
+    def end(self):
+        end_ns = perf_counter_ns()
+        event = {'name': self.name,
+                 'cat': self.cat,
+                 'ph': 'X',
+                 'ts': (self.start_ns - _start_ns) / 1000,
+                 'dur': (end_ns - self.start_ns) / 1000,
+                 'pid': os.getpid(),
+                 'tid': self.tid,
+                 }
+        if self.args:
+            event['args'] = self.args
+        # list.append is atomic, spans end in many threads
+        _events.append(event)
+
+def enabled():
+    return _filename is not None
+
+def span(name, cat='e621dl', **args):
+    if _filename is None:
+        return _NULL_SPAN
+    return _Span(name, cat, args)
+
+def start(filename):
+    global _filename, _start_ns
+    with _lock:
+        if _filename is not None:
+            return
+        _start_ns = perf_counter_ns()
+        _filename = filename
+
+# Writes everything recorded so far, tracing stays on
+def save():
+    with _lock:
+        if _filename is None:
+            return
+        events = list(_events)
+        pid = os.getpid()
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                    for tid, name in list(_thread_names.items())]
+
+        temp_filename = f'{_filename}.tmp'
+        with open(temp_filename, 'w') as outfile:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, outfile)
+        os.replace(temp_filename, _filename)
+
+def stop():
+    global _filename
+    save()
+    with _lock:
+        _filename = None
+        _events.clear()
+        _thread_names.clear()